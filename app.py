@@ -1,14 +1,29 @@
+import benchmarks
+import cache
+import click
 import copy
-import json
+import counters
+import dashboard
+import deletion
+import functools
+import hashlib
+import metrics
+import migrations
 import mongo
 import os
+import search
 import settings
+import time
 import utils
+import versions
 from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
 from celery import Celery
+from celery.signals import before_task_publish, task_postrun, task_prerun
 from datetime import datetime
 from dotenv import load_dotenv
-from flask import Flask, jsonify, request, Response
+from flask import abort, Flask, g, json, jsonify, request, Response, stream_with_context
 from flask_mail import Mail, Message
 
 
@@ -33,6 +48,10 @@ def make_celery(app):
 
 
 app = Flask(__name__)
+if utils.DefaultJSONProvider:
+    app.json = utils.MongoJSONProvider(app)
+else:
+    app.json_encoder = utils.MongoJSONEncoder
 app.config.from_object(settings)
 app.config.update(
     broker_url=os.environ.get("broker_url"),
@@ -46,6 +65,56 @@ mail = Mail(app)
 
 celery = make_celery(app)
 # celery -A app.celery worker --loglevel=info --pool=solo
+celery.conf.beat_schedule = {
+    'reconcile-counters': {'task': 'app.reconcile_counters', 'schedule': 3600},
+    'resume-contract-purges': {'task': 'app.resume_contract_purges', 'schedule': 600},
+}
+# celery -A app.celery beat --loglevel=info
+
+app.cli.add_command(benchmarks.benchmark_cli)
+app.cli.add_command(migrations.migrate_cli)
+
+
+@app.cli.command('ensure-indexes')
+def ensure_indexes_command():
+    mongo.ensure_indexes()
+
+
+@app.cli.command('explain-queries')
+def explain_queries_command():
+    collection_scans = mongo.find_collection_scans(mongo.query_shapes)
+    for collection_name, query, sort in collection_scans:
+        click.echo(f'COLLSCAN on {collection_name}: query {query}, sort {sort}')
+    if collection_scans:
+        raise SystemExit(1)
+    click.echo(f'{len(mongo.query_shapes)} query shapes use indexes')
+
+
+@app.cli.command('rebuild-counters')
+def rebuild_counters_command():
+    click.echo(f'{counters.rebuild_counters()} employee counters rebuilt')
+
+
+@app.cli.command('rebuild-dashboards')
+def rebuild_dashboards_command():
+    click.echo(f'{dashboard.rebuild_dashboards()} company dashboards rebuilt')
+
+
+@app.cli.command('rebuild-search-index')
+@click.option('--batch-size', default=500, show_default=True)
+def rebuild_search_index_command(batch_size):
+    click.echo(f'{search.rebuild_search_index(batch_size)} contracts, comments and messages indexed')
+
+
+@app.cli.command('text-size-report')
+def text_size_report_command():
+    for collection_name, fields in mongo.compressed_fields.items():
+        for field in fields:
+            sizes = mongo.get_text_sizes(collection_name, field)
+            ratio = sizes['text_bytes'] / sizes['stored_bytes'] if sizes['stored_bytes'] else 1
+            click.echo(f"{collection_name}.{field}: {sizes['documents']} documents, "
+                       f"{sizes['compressed_documents']} compressed, {sizes['text_bytes']} text bytes, "
+                       f"{sizes['stored_bytes']} stored bytes, ratio {ratio:.2f}")
 
 
 @celery.task
@@ -58,49 +127,172 @@ def send_email_notification(contract_id, message_text, receivers_emails):
         mail.send(msg)
 
 
+@celery.task
+def reconcile_counters():
+    counters.rebuild_counters()
+
+
+@celery.task(acks_late=True)
+def purge_contract(contract_id):
+    deletion.purge_contract(contract_id)
+
+
+@celery.task
+def resume_contract_purges():
+    for contract_id in deletion.find_stalled_purges():
+        purge_contract.delay(contract_id)
+
+
+@before_task_publish.connect
+def stamp_task_publish_time(headers=None, **kwargs):
+    headers['published_at'] = time.time()
+
+
+@task_prerun.connect
+def start_task_metrics(task=None, **kwargs):
+    published_at = task.request.get('published_at') or (task.request.get('headers') or {}).get('published_at')
+    if published_at:
+        metrics.observe_task('queue_lag', task.name, max(time.time() - published_at, 0))
+    task.request.metrics_started = time.perf_counter()
+
+
+@task_postrun.connect
+def finish_task_metrics(task=None, **kwargs):
+    started = getattr(task.request, 'metrics_started', None)
+    if started is not None:
+        metrics.observe_task('duration', task.name, time.perf_counter() - started)
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    mongo.command_log.set(mongo.CommandLog())
+
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    if 'request_started' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe_request(request.method, route, time.perf_counter() - g.request_started,
+                                mongo.command_log.get())
+    mongo.command_log.set(None)
+
+
+def routed_reads(view):
+    @functools.wraps(view)
+    def routed_view(*args, **kwargs):
+        with mongo.routed_reads():
+            return view(*args, **kwargs)
+    return routed_view
+
+
+class RevisionConflict(Exception):
+    def __init__(self, revision):
+        super().__init__(revision)
+        self.revision = revision
+
+
+@app.errorhandler(RevisionConflict)
+def handle_revision_conflict(error):
+    return jsonify({'revision': error.revision}), 409
+
+
+@app.errorhandler(mongo.InvalidCursor)
+def handle_invalid_cursor(error):
+    return jsonify(str(error)), 400
+
+
+@app.after_request
+def set_etag(response):
+    if 'etag' in g and response.status_code in (200, 304):
+        response.set_etag(g.etag)
+    return response
+
+
 @app.route('/invitation/change/<invitation_id>/<new_status>', methods=['GET'])
 def change_invitation_status(invitation_id, new_status):
-    invitation = mongo.find_one_document('invitation', {'_id': ObjectId(invitation_id)})
-    invitation['status'] = new_status
-    mongo.update_one_document('invitation', invitation_id, invitation)
+    invitation = mongo.find_one_and_update('invitation', {'_id': ObjectId(invitation_id)},
+                                           {'$set': {'status': new_status}},
+                                           {'status': True, 'type': True, 'recipient.id': True,
+                                            'recipient.company_id': True})
+    was_pending, is_pending = invitation['status'] == 'pending', new_status == 'pending'
+    if was_pending != is_pending:
+        counters.change_counters([invitation['recipient']['id']], 'invitations', 1 if is_pending else -1)
+        dashboard.change_invitation_counts(invitation['recipient']['company_id'], invitation['type'],
+                                           1 if is_pending else -1)
     return jsonify('Changed')
 
 
 @app.route('/items/check/<employee_id>', methods=['GET'])
 def check_new_items(employee_id):
-    new_notification = bool(list(mongo.find_documents('notification', {'recipient_id': employee_id, 'is_read': False})))
-    new_invitation = bool(list(mongo.find_documents('invitation', {'recipient.id': employee_id, 'status': 'pending'})))
-    new_dialog = bool(list(mongo.find_documents('message', {f'is_read.{employee_id}': False})))
-    return jsonify({'Dialogs': new_dialog, 'Invitations': new_invitation, 'Notifications': new_notification})
+    employee_counters = counters.get_counters(employee_id)
+    items_counts = {'Dialogs': employee_counters['messages'], 'Invitations': employee_counters['invitations'],
+                    'Notifications': employee_counters['notifications']}
+    new_items = {items_name: bool(items_count) for items_name, items_count in items_counts.items()}
+    return jsonify({**new_items, 'counts': items_counts})
+
+
+@app.route('/export/contracts/<employee_id>', methods=['GET'])
+@routed_reads
+def export_contracts(employee_id):
+    employee_company_id = cache.find_employee(employee_id)['company_id']
+    query = {'companies': {'$elemMatch': {'id': employee_company_id}}, **deletion.live_contract_query}
+    return export_documents('contract', query, {'comment_anchors': False})
+
+
+@app.route('/export/dialogs/<employee_id>', methods=['GET'])
+@routed_reads
+def export_dialogs(employee_id):
+    query = deletion.exclude_deleted_contracts({'participants': {'$elemMatch': {'id': employee_id}}})
+    return export_documents('dialog', query)
+
+
+@app.route('/export/invitations/<employee_id>', methods=['GET'])
+@routed_reads
+def export_invitations(employee_id):
+    query = deletion.exclude_deleted_contracts({'$or': [{'creator.id': employee_id}, {'recipient.id': employee_id}]})
+    return export_documents('invitation', query)
+
+
+@app.route('/export/notifications/<employee_id>', methods=['GET'])
+@routed_reads
+def export_notifications(employee_id):
+    query = deletion.exclude_deleted_contracts({'recipient_id': employee_id})
+    return export_documents('notification', query)
 
 
 @app.route('/comments', methods=['GET'])
 def get_comments():
     contract_id = request.args.get('contract_id')
+    contract = get_contract_revisions(contract_id, 'revision', 'comments_revision', 'comment_anchors')
+    if is_not_modified(contract.get('revision'), contract.get('comments_revision')):
+        return Response(status=304)
     comments = list(mongo.find_documents('comment', {'contract_id': contract_id}))
-    comments = json.loads(utils.convert_mongo_data_to_json(comments))
     for comment in comments:
-        comment['related_comments'] = sorted(comment['related_comments'], key=lambda comment: utils.transform_field(
-            comment['creation_date'], 'creation_date'))
+        comment['related_comments'] = sorted(comment['related_comments'],
+                                             key=lambda comment: mongo.get_date_sort_key(comment['creation_date']))
         for related_comment in comment['related_comments']:
-            related_comment['creation_date'] = datetime.strptime(related_comment['creation_date'], '%d.%m.%y %H:%M:%S')\
-                .strftime('%d.%m.%y %H:%M')
-    contract = mongo.find_one_document('contract', {'_id': ObjectId(contract_id)})
-    comments = sorted(comments, key=lambda comment: utils.key_func_for_sorting_comments(comment, contract['text']))
+            related_comment['creation_date'] = utils.format_date(related_comment['creation_date'])
+    comment_anchors = contract.get('comment_anchors')
+    if comment_anchors is None:
+        contract = find_contract(contract_id, {'text': True})
+        comment_anchors = utils.find_comment_anchors(contract['text'])
+        mongo.update_one_document('contract', contract_id, {'comment_anchors': comment_anchors})
+    comments = sorted(comments, key=lambda comment: utils.key_func_for_sorting_comments(comment, comment_anchors))
     return jsonify(comments)
 
 
 @app.route('/companies', methods=['GET'])
+@routed_reads
 def get_companies():
     companies = list(mongo.find_documents('company', {}))
-    companies = json.loads(utils.convert_mongo_data_to_json(companies))
     employee_id = request.args.get('user_id')
-    employee_company_id = mongo.find_one_document('employee', {'_id': ObjectId(employee_id)})['company_id']
+    employee_company_id = cache.find_employee(employee_id)['company_id']
     zesla_group_id = '60338c13136d90fcdc76de24'
     default_companies = []
     companies_to_choose = []
     for company in companies:
-        if company['_id'] in [employee_company_id, zesla_group_id]:
+        if str(company['_id']) in [employee_company_id, zesla_group_id]:
             if default_companies and default_companies[0] == company:
                 continue
             default_companies.append(company)
@@ -111,67 +303,81 @@ def get_companies():
 
 @app.route('/contract/<contract_id>/<employee_id>', methods=['GET'])
 def get_contract(contract_id, employee_id):
-    contract = mongo.find_one_document('contract', {'_id': ObjectId(contract_id)})
-    contract = json.loads(utils.convert_mongo_data_to_json(contract))
-    creation_date = datetime.strptime(contract['creation_date'], '%d.%m.%y %H:%M:%S').strftime('%d.%m.%y %H:%M')
-    contract['creation_date'] = creation_date
-    employee = mongo.find_one_document('employee', {'_id': ObjectId(employee_id)})
-    user_company = mongo.find_one_document('company', {'_id': ObjectId(employee['company_id'])})['name']
-    user_role = mongo.find_one_document('role', {'_id': ObjectId(employee['role_id'])})['name']
+    user_company, user_role = cache.find_employee_company_and_role(employee_id)
+    contract = get_contract_revisions(contract_id, 'revision')
+    if is_not_modified(contract.get('revision'), user_company, user_role):
+        return Response(status=304)
+    contract = find_contract(contract_id, {'comment_anchors': False})
+    contract['creation_date'] = utils.format_date(contract['creation_date'])
     action, acceptances = utils.define_action_on_status_and_acceptances(user_company, user_role, contract['status'])
     contract.update({'actionOnStatus': action, 'companiesAcceptances': acceptances})
     return jsonify(contract)
 
 
 @app.route('/contracts/<employee_id>', methods=['GET'])
+@routed_reads
 def get_contracts(employee_id):
-    employee = mongo.find_one_document('employee', {'_id': ObjectId(employee_id)})
+    employee = cache.find_employee(employee_id)
     employee_company_id = employee['company_id']
-    contracts = list(mongo.find_documents('contract', {'companies': {'$elemMatch': {'id': employee_company_id}}}))
-    contracts = json.loads(utils.convert_mongo_data_to_json(contracts))
-    sorting_field = request.args.get('field')
-    if sorting_field == 'undefined':
-        contracts = sorted(contracts, key=lambda contract: utils.transform_field(
-        contract['creation_date'], 'creation_date'), reverse=True)
-    else:
-        reverse = True if request.args.get('reverse') == 'true' else False
-        if sorting_field == 'status':
-            contracts = sorted(contracts, key=lambda contract: contract['status']['name'], reverse=reverse)
-        else:
-            contracts = sorted(contracts, key=lambda contract: utils.transform_field(
-                contract[sorting_field], sorting_field), reverse=reverse)
-    current_page, per_page = int(request.args.get('page')), int(request.args.get('per_page'))
-    pagination_entities = utils.apply_pagination(current_page, per_page, contracts)
+    query = {'companies': {'$elemMatch': {'id': employee_company_id}}, **deletion.live_contract_query}
+    sorting_field, descending = utils.define_db_sorting(request.args.get('field'), request.args.get('reverse'),
+                                                        {'status': 'status.name'})
+    current_page, per_page = request.args.get('page', 1, type=int), int(request.args.get('per_page'))
+    pagination_entities = mongo.find_page('contract', query, sorting_field, descending, current_page, per_page,
+                                          request.args.get('after'), utils.contract_list_projection)
     for contract in pagination_entities['records']:
-        creation_date = datetime.strptime(contract['creation_date'], '%d.%m.%y %H:%M:%S').strftime('%d.%m.%y %H:%M')
-        contract['creation_date'] = creation_date
+        contract['creation_date'] = utils.format_date(contract['creation_date'])
     return jsonify(pagination_entities)
 
 
+@app.route('/contract/version/<version_id>', methods=['GET'])
+def get_contract_version(version_id):
+    version = mongo.find_one_document('version', {'_id': ObjectId(version_id)}, utils.version_metadata_projection)
+    if not version or version['contract_id'] in deletion.find_deleted_contracts_id():
+        abort(404)
+    version['creation_date'] = utils.format_date(version['creation_date'])
+    version['text'] = versions.get_version_text(version_id)
+    return jsonify(version)
+
+
 @app.route('/contract/versions/<contract_id>/<employee_id>', methods=['GET'])
+@routed_reads
 def get_contract_versions(contract_id, employee_id):
-    versions = list(mongo.find_documents('version', {'contract_id': contract_id, 'creator_id': employee_id}))
-    versions = json.loads(utils.convert_mongo_data_to_json(versions))
-    versions = sorted(versions, key=lambda version: utils.transform_field(version['creation_date'], 'creation_date'))
-    for version in versions:
-        creation_date = datetime.strptime(version['creation_date'], '%d.%m.%y %H:%M:%S').strftime('%d.%m.%y %H:%M')
-        version['creation_date'] = creation_date
-    return jsonify(versions)
+    contract = get_contract_revisions(contract_id, 'versions_revision')
+    if is_not_modified(contract.get('versions_revision')):
+        return Response(status=304)
+    query = {'contract_id': contract_id, 'creator_id': employee_id}
+    contract_versions = list(mongo.find_documents('version', query, projection=utils.version_metadata_projection))
+    contract_versions = sorted(contract_versions,
+                               key=lambda version: mongo.get_date_sort_key(version['creation_date']))
+    for version in contract_versions:
+        version['creation_date'] = utils.format_date(version['creation_date'])
+    return jsonify(contract_versions)
+
+
+@app.route('/dashboard/<employee_id>', methods=['GET'])
+@routed_reads
+def get_dashboard(employee_id):
+    employee = cache.find_employee(employee_id)
+    return jsonify(dashboard.get_dashboard(employee['company_id']))
 
 
 @app.route('/dialog/variants/<contract_id>/<employee_id>', methods=['GET'])
 def get_dialog_variants(contract_id, employee_id):
-    contract = mongo.find_one_document('contract', {'_id': ObjectId(contract_id)})
+    contract = find_contract(contract_id, {'companies': True})
+    companies_names = {company['id']: company['name'] for company in contract['companies']}
     employees_for_dialog = []
-    for company in contract['companies']:
-        company_employees = mongo.find_documents('employee', {'company_id': company['id']})
-        for employee in company_employees:
-            if employee_id != str(employee['_id']):
-                employees_for_dialog.append(
-                    {'id': str(employee['_id']), 'name': employee['name'], 'companyName': company['name']}
-                )
+    employees_query = {'company_id': {'$in': list(companies_names)}}
+    employees_projection = {'name': True, 'company_id': True}
+    contract_employees = mongo.find_documents('employee', employees_query, projection=employees_projection)
+    for employee in contract_employees:
+        if employee_id != str(employee['_id']):
+            employees_for_dialog.append(
+                {'id': str(employee['_id']), 'name': employee['name'],
+                 'companyName': companies_names[employee['company_id']]}
+            )
     query = {'contract_id': contract_id, 'participants': {'$elemMatch': {'id': employee_id}}}
-    existing_dialogs = mongo.find_documents('dialog', query)
+    existing_dialogs = mongo.find_documents('dialog', query, projection={'participants': True})
     everybody = {'id': 'everybody', 'name': 'Everybody', 'companyName': ''}
     employees_to_exclude = []
     for dialog in existing_dialogs:
@@ -190,66 +396,87 @@ def get_dialog_variants(contract_id, employee_id):
 
 @app.route('/dialog/<dialog_id>/<employee_id>', methods=['GET'])
 def get_dialog(dialog_id, employee_id):
-    dialog = mongo.find_one_document('dialog', {'_id': ObjectId(dialog_id)})
+    dialog_projection = {'contract_id': True, 'participants': True}
+    dialog = mongo.find_one_document('dialog', {'_id': ObjectId(dialog_id)}, dialog_projection)
+    if not dialog or dialog['contract_id'] in deletion.find_deleted_contracts_id():
+        abort(404)
     contract_id, participants = dialog['contract_id'], dialog['participants']
-    messages = list(mongo.find_documents('message', {'dialog_id': dialog_id}))
+    query = {'dialog_id': dialog_id}
+    before = request.args.get('before')
+    if before:
+        try:
+            query['_id'] = {'$lt': ObjectId(before)}
+        except InvalidId:
+            abort(400)
+    try:
+        limit = int(request.args.get('limit', utils.messages_page_size))
+    except ValueError:
+        abort(400)
+    limit = min(max(limit, 1), utils.max_messages_page_size)
+    messages = list(mongo.find_documents('message', query, [('_id', mongo.DESC)], limit + 1))
+    has_earlier_messages = len(messages) > limit
+    messages = messages[:limit]
+    messages_id = [message['_id'] for message in messages]
+    read_update = {'$pull': {'unread_by': employee_id}, '$addToSet': {'read_by': employee_id}}
+    read_count = mongo.update_many_documents('message', {'_id': {'$in': messages_id}, 'unread_by': employee_id},
+                                             read_update)
+    if read_count:
+        counters.change_counters([employee_id], 'messages', -read_count)
+        last_message_query = {'_id': ObjectId(dialog_id), 'last_message._id': {'$in': messages_id},
+                              'last_message.unread_by': employee_id}
+        last_message_read_update = {'$pull': {'last_message.unread_by': employee_id},
+                                    '$addToSet': {'last_message.read_by': employee_id}}
+        last_message_read_update['$inc'] = {'revision': 1}
+        mongo.update_one_by_query('dialog', last_message_query, last_message_read_update)
+        counters.change_counters([participant['id'] for participant in participants], 'dialogs_revision')
+    messages.reverse()
     for message in messages:
-        if message['sender']['id'] == employee_id:
-            message['is_read'] = any(message['is_read'].values())
-        else:
-            message['is_read'][employee_id] = True
-            mongo.update_one_document('message', str(message['_id']), message)
-            message['is_read'] = True
+        message['is_read'] = message['sender']['id'] != employee_id or bool(message['read_by'])
+        del message['unread_by'], message['read_by']
         message['_id'] = str(message['_id'])
-    messages = sorted(messages, key=lambda message: utils.transform_field(message['creation_date'], 'creation_date'))
-    return jsonify({'messages': messages, 'contractId': contract_id, 'participants': participants})
+        message['creation_date'] = utils.format_date(message['creation_date'], utils.date_format)
+    before = messages[0]['_id'] if has_earlier_messages else None
+    return jsonify({'messages': messages, 'contractId': contract_id, 'participants': participants, 'before': before})
 
 
 @app.route('/dialogs/<employee_id>', methods=['GET'])
+@routed_reads
 def get_dialogs(employee_id):
+    deleted_contracts_id = deletion.find_deleted_contracts_id()
+    if is_not_modified(counters.get_dialogs_revision(employee_id), deleted_contracts_id):
+        return Response(status=304)
     contract_id = request.args.get('contract_id')
     query = {'participants': {'$elemMatch': {'id': employee_id}}}
     if contract_id != 'undefined':
         query['contract_id'] = contract_id
-    dialogs = mongo.find_documents('dialog', query)
-    dialogs_entities = []
-    for dialog in dialogs:
-        dialog_id, dialog_contract_id, participants = str(dialog['_id']), dialog['contract_id'], dialog['participants']
-        dialog_messages = list(mongo.find_documents('message', {'dialog_id': dialog_id}))
-        latest_message = sorted(dialog_messages, key=lambda message: utils.transform_field(
-            message['creation_date'], 'creation_date'), reverse=True)[0]
-        latest_message = json.loads(utils.convert_mongo_data_to_json(latest_message))
-        if latest_message['sender']['id'] == employee_id:
-            latest_message['is_read'] = any(latest_message['is_read'].values())
-        else:
-            latest_message['is_read'] = latest_message['is_read'][employee_id]
-        latest_message.update({'contract_id': dialog_contract_id, 'participants': participants})
-        dialogs_entities.append(latest_message)
+    query = deletion.exclude_deleted_contracts(query, deleted_contracts_id)
     if request.args.get('page') == 'undefined':
-        dialogs_entities = sorted(dialogs_entities, key=lambda message: utils.transform_field(
-            message['creation_date'], 'creation_date'), reverse=True)
-        return jsonify({'currentPage': 1, 'pagesCount': 1, 'records': dialogs_entities})
-    sorting_field = request.args.get('field')
-    reverse = True
-    if sorting_field == 'undefined':
-        sorting_field = 'creation_date'
+        sort = [('last_message.creation_date', mongo.DESC), ('_id', mongo.DESC)]
+        dialogs = list(mongo.find_documents('dialog', query, sort))
+        pagination_entities = {'currentPage': 1, 'pagesCount': 1, 'records': dialogs}
     else:
-        reverse = True if request.args.get('reverse') == 'true' else False
-    dialogs_entities = sorted(dialogs_entities, key=lambda message: utils.transform_field(
-        message[sorting_field], sorting_field), reverse=reverse)
-    current_page, per_page = int(request.args.get('page')), int(request.args.get('per_page'))
-    pagination_entities = utils.apply_pagination(current_page, per_page, dialogs_entities)
+        sorting_fields_map = {'creation_date': 'last_message.creation_date', 'text': 'last_message.text',
+                              'sender': 'last_message.sender.name'}
+        sorting_field, descending = utils.define_db_sorting(request.args.get('field'), request.args.get('reverse'),
+                                                            sorting_fields_map)
+        current_page, per_page = request.args.get('page', 1, type=int), int(request.args.get('per_page'))
+        pagination_entities = mongo.find_page('dialog', query, sorting_field, descending, current_page, per_page,
+                                              request.args.get('after'))
+    pagination_entities['records'] = [utils.create_dialog_entity(dialog, employee_id)
+                                      for dialog in pagination_entities['records']]
     return jsonify(pagination_entities)
 
 
 @app.route('/employees/roles/<employee_id>', methods=['GET'])
+@routed_reads
 def get_employees_roles(employee_id):
-    employee = mongo.find_one_document('employee', {'_id': ObjectId(employee_id)})
-    employee_company_id = employee['company_id']
-    company_employees = mongo.find_documents('employee', {'company_id': employee_company_id})
+    employee_company_id = cache.find_employee(employee_id)['company_id']
+    company_employees = list(mongo.find_documents('employee', {'company_id': employee_company_id},
+                                                  projection={'name': True, 'role_id': True}))
+    roles = cache.find_roles([employee['role_id'] for employee in company_employees])
     employees_info = []
     for employee in company_employees:
-        role_name = mongo.find_one_document('role', {'_id': ObjectId(employee['role_id'])})['name']
+        role_name = roles[employee['role_id']]['name']
         employee_info = {'employeeId': str(employee['_id']), 'employeeName': employee['name'], 'savedRole': role_name}
         employees_info.append(employee_info)
     employees_info = sorted(employees_info, key=lambda employee_info: employee_info['employeeName'])
@@ -258,8 +485,8 @@ def get_employees_roles(employee_id):
 
 @app.route('/invitation/variants/<contract_id>/<employee_id>', methods=['GET'])
 def get_invitation_variants(contract_id, employee_id):
-    contract = mongo.find_one_document('contract', {'_id': ObjectId(contract_id)})
-    employee = mongo.find_one_document('employee', {'_id': ObjectId(employee_id)})
+    contract = find_contract(contract_id, {'companies': True, 'status.name': True})
+    employee = cache.find_employee(employee_id)
     companies_to_invite = [company for company in contract['companies'] if company['id'] != employee['company_id']]
     types_map = {
         'creating': {'editing': copy.deepcopy(companies_to_invite),
@@ -274,63 +501,69 @@ def get_invitation_variants(contract_id, employee_id):
         queries = []
         for invitation_type in invitation_types:
             queries.append({'contract_id': contract_id, 'type': invitation_type})
-        invitations = mongo.find_documents_under_operator('invitation', 'or', queries)
+        invitations = mongo.find_documents_under_operator('invitation', 'or', queries,
+                                                          {'type': True, 'recipient.company_id': True})
         invitation_variants = utils.remove_companies_from_invitation(invitation_variants, invitations)
     return jsonify(invitation_variants)
 
 
 @app.route('/invitations/<employee_id>', methods=['GET'])
+@routed_reads
 def get_invitations(employee_id):
     contract_id = request.args.get('contract_id')
     queries = [{'creator.id': employee_id}, {'recipient.id': employee_id}]
     if contract_id != 'undefined':
         for query in queries:
             query['contract_id'] = contract_id
-    invitations = list(mongo.find_documents_under_operator('invitation', 'or', queries))
-    invitations = json.loads(utils.convert_mongo_data_to_json(invitations))
-    sorting_field = request.args.get('field')
-    if sorting_field == 'undefined':
-        invitations = sorted(invitations, key=lambda invitation: utils.transform_field(
-        invitation['creation_date'], 'creation_date'), reverse=True)
-    else:
-        reverse = True if request.args.get('reverse') == 'true' else False
-        if sorting_field in ['creator', 'recipient']:
-            invitations = sorted(invitations, key=lambda invitation: invitation[sorting_field]['name'], reverse=reverse)
-        else:
-            invitations = sorted(invitations, key=lambda invitation: utils.transform_field(
-                invitation[sorting_field], sorting_field), reverse=reverse)
-    current_page, per_page = int(request.args.get('page')), int(request.args.get('per_page'))
-    pagination_entities = utils.apply_pagination(current_page, per_page, invitations)
+    sorting_field, descending = utils.define_db_sorting(request.args.get('field'), request.args.get('reverse'),
+                                                        {'creator': 'creator.name', 'recipient': 'recipient.name'})
+    current_page, per_page = request.args.get('page', 1, type=int), int(request.args.get('per_page'))
+    query = deletion.exclude_deleted_contracts({'$or': queries})
+    pagination_entities = mongo.find_page('invitation', query, sorting_field, descending, current_page,
+                                          per_page, request.args.get('after'))
+    for invitation in pagination_entities['records']:
+        invitation['creation_date'] = utils.format_date(invitation['creation_date'])
     for invitation in pagination_entities['records']:
-        creation_date = datetime.strptime(invitation['creation_date'], '%d.%m.%y %H:%M:%S').strftime('%d.%m.%y %H:%M')
-        invitation['creation_date'] = creation_date
         user_is_creator = invitation['creator']['id'] == employee_id
         actions = not user_is_creator and invitation['status'] == 'pending'
         invitation.update({'actions': actions, 'userIsCreator': user_is_creator})
     return jsonify(pagination_entities)
 
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/notifications/<employee_id>', methods=['GET'])
+@routed_reads
 def get_notifications(employee_id):
     contract_id = request.args.get('contract_id')
     query = {'recipient_id': employee_id}
     if contract_id != 'undefined':
         query['contract_id'] = contract_id
-    notifications = list(mongo.find_documents('notification', query))
-    notifications = json.loads(utils.convert_mongo_data_to_json(notifications))
-    sorting_field = request.args.get('field')
-    reverse = True
-    if sorting_field == 'undefined':
-        sorting_field = 'creation_date'
-    else:
-        reverse = True if request.args.get('reverse') == 'true' else False
-    notifications = sorted(notifications, key=lambda notification: utils.transform_field(
-        notification[sorting_field], sorting_field), reverse=reverse)
-    current_page, per_page = int(request.args.get('page')), int(request.args.get('per_page'))
-    pagination_entities = utils.apply_pagination(current_page, per_page, notifications)
+    query = deletion.exclude_deleted_contracts(query)
+    sorting_field, descending = utils.define_db_sorting(request.args.get('field'), request.args.get('reverse'), {})
+    current_page, per_page = request.args.get('page', 1, type=int), int(request.args.get('per_page'))
+    pagination_entities = mongo.find_page('notification', query, sorting_field, descending, current_page, per_page,
+                                          request.args.get('after'))
     for notification in pagination_entities['records']:
-        creation_date = datetime.strptime(notification['creation_date'], '%d.%m.%y %H:%M:%S').strftime('%d.%m.%y %H:%M')
-        notification['creation_date'] = creation_date
+        notification['creation_date'] = utils.format_date(notification['creation_date'])
+    return jsonify(pagination_entities)
+
+
+@app.route('/search/<employee_id>', methods=['GET'])
+@routed_reads
+def search_items(employee_id):
+    query_text = request.args.get('q', '').strip()
+    if not query_text:
+        abort(400)
+    employee_company_id = cache.find_employee(employee_id)['company_id']
+    current_page, per_page = request.args.get('page', 1, type=int), request.args.get('per_page', 10, type=int)
+    pagination_entities = search.search(employee_company_id, employee_id, query_text, current_page, per_page)
+    for record in pagination_entities['records']:
+        if 'creation_date' in record:
+            record['creation_date'] = utils.format_date(record['creation_date'], utils.date_format)
     return jsonify(pagination_entities)
 
 
@@ -339,50 +572,57 @@ def get_user():
     username = request.args.get('name')
     user = mongo.find_one_document('employee', {'name': username})
     if user:
-        user_role = mongo.find_one_document('role', {'_id': ObjectId(user['role_id'])})['name']
+        user_role = cache.find_role(user['role_id'])['name']
         user = {'userId': user['_id'], 'userRole': user_role}
     else:
         user = ''
-    return Response(utils.convert_mongo_data_to_json(user), mimetype='application/json')
+    return jsonify(user)
 
 
 @app.route('/notification/read/<notification_id>', methods=['GET'])
 def make_notification_read(notification_id):
-    notification = mongo.find_one_document('notification', {'_id': ObjectId(notification_id)})
-    notification['is_read'] = True
-    mongo.update_one_document('notification', notification_id, notification)
+    notification = mongo.find_one_and_update('notification', {'_id': ObjectId(notification_id), 'is_read': False},
+                                             {'$set': {'is_read': True}}, {'recipient_id': True})
+    if notification:
+        counters.change_counters([notification['recipient_id']], 'notifications', -1)
     return jsonify('Changed')
 
 
 @app.route('/contract/version/save/<contract_id>/<employee_id>', methods=['GET'])
 def save_contract_version(contract_id, employee_id):
-    contract = mongo.find_one_document('contract', {'_id': ObjectId(contract_id)})
-    version = {
-        'contract_id': contract_id, 'creator_id': employee_id, 'text': contract['text'],
-        'creation_date': datetime.now().strftime('%d.%m.%y %H:%M:%S'), 'contract_status': contract['status']['name']
-    }
-    mongo.insert_one_document('version', version)
+    contract = find_contract(contract_id, {'text': True, 'status.name': True})
+    versions.save_version(contract_id, employee_id, contract['text'], datetime.now(), contract['status']['name'])
     return jsonify('Saved')
 
 
 @app.route('/contract/status/update/<contract_id>/<employee_id>', methods=['GET'])
 def update_contract_status(contract_id, employee_id):
     action_on_status = request.args.get('action')
-    contract = mongo.find_one_document('contract', {'_id': ObjectId(contract_id)})
-    contract = json.loads(utils.convert_mongo_data_to_json(contract))
-    employee = mongo.find_one_document('employee', {'_id': ObjectId(employee_id)})
-    user_company = mongo.find_one_document('company', {'_id': ObjectId(employee['company_id'])})['name']
-    user_role = mongo.find_one_document('role', {'_id': ObjectId(employee['role_id'])})['name']
-    initial_status_name = contract['status']['name']
-    updated_status = utils.update_status(action_on_status, user_company, user_role, contract['status'])
+    user_company, user_role = cache.find_employee_company_and_role(employee_id)
+    contract_projection = {'companies': True, 'status': True, 'status_changed_date': True, 'revision': True}
+    for attempt in range(utils.update_attempts):
+        contract = find_contract(contract_id, contract_projection)
+        initial_status_name = contract['status']['name']
+        updated_status = utils.update_status(action_on_status, user_company, user_role, contract['status'])
+        status_update = {'$set': {'status': updated_status}}
+        status_changed_date = datetime.now()
+        if updated_status['name'] != initial_status_name:
+            status_update['$set']['status_changed_date'] = status_changed_date
+        if mongo.update_with_revision('contract', contract_id, contract.get('revision'), status_update):
+            break
+    else:
+        return jsonify('Conflict'), 409
     final_status_name = updated_status['name']
-    contract['status'] = updated_status
-    del contract['_id']
-    mongo.update_one_document('contract', contract_id, contract)
+    if final_status_name != initial_status_name:
+        dashboard.record_status_change([company['id'] for company in contract['companies']], initial_status_name,
+                                       final_status_name, contract.get('status_changed_date'), status_changed_date)
     invitations_types_map = {'harmonization': 'editing', 'harmonized': 'harmonization', 'signed': 'signing'}
     invitation_type_to_delete = invitations_types_map.get(final_status_name)
     if invitation_type_to_delete:
-        mongo.delete_many_documents('invitation', {'contract_id': contract_id, 'type': invitation_type_to_delete})
+        invitations_query = {'contract_id': contract_id, 'type': invitation_type_to_delete}
+        counters.discount_items('invitations', invitations_query)
+        dashboard.discount_invitations(invitations_query)
+        mongo.delete_many_documents('invitation', invitations_query)
     notifications_types_map = {
         ('creating', 'harmonization'): 'harmonization',
         ('harmonization', 'harmonized'): 'signing',
@@ -392,10 +632,10 @@ def update_contract_status(contract_id, employee_id):
     if notification_type:
         contract_companies_id = [company['id'] for company in contract['companies']]
         queries = [{'company_id': id} for id in contract_companies_id]
-        director_role = mongo.find_one_document('role', {'name': 'director'})
-        director_role_id = str(director_role['_id'])
+        director_role_id = str(cache.find_role_by_name('director')['_id'])
         notification_recipients = []
-        for employee in mongo.find_documents_under_operator('employee', 'or', queries):
+        employees = mongo.find_documents_under_operator('employee', 'or', queries, {'email': True, 'role_id': True})
+        for employee in employees:
             notification_recipient = {'id': str(employee['_id']), 'email': employee['email']}
             if notification_type == 'signing':
                 if employee['role_id'] == director_role_id:
@@ -406,33 +646,40 @@ def update_contract_status(contract_id, employee_id):
         create_notifications(contract_id, notification_recipients, notification_type)
     if action_on_status == 'Harmonize':
         mongo.delete_many_documents('comment', {'contract_id': contract_id})
+        bump_comments_revision(contract_id)
+        search.remove_comments(contract_id)
     return jsonify('Updated')
 
 
 @app.route('/comment/create', methods=['POST'])
 def create_comment():
-    contract_id, contract_text, author, text, number = request.json['contractId'], request.json['contractText'], \
-                                                       request.json['userName'], request.json['text'], \
-                                                       request.json['number']
+    contract_id, author, text, number = request.json['contractId'], request.json['userName'], request.json['text'], \
+                                        request.json['number']
+    contract_text, text_patch = get_contract_text_change(contract_id, request.json, 'contractText')
+    revision = update_contract_text(contract_id, contract_text, text_patch=text_patch)
     comment = {'contract_id': contract_id, 'number': number,
                'related_comments': [{'id': 0, 'author': author, 'text': text,
-                                     'creation_date': datetime.now().strftime('%d.%m.%y %H:%M:%S')}]
+                                     'creation_date': datetime.now()}]
                }
     mongo.insert_one_document('comment', comment)
-    contract = mongo.find_one_document('contract', {'_id': ObjectId(contract_id)})
-    contract['text'] = contract_text
-    mongo.update_one_document('contract', contract_id, contract)
-    return jsonify('Created'), 201
+    bump_comments_revision(contract_id)
+    search.index_comment(contract_id, number)
+    return jsonify({'revision': revision} if text_patch else 'Created'), 201
 
 
 @app.route('/contract/create', methods=['POST'])
 def create_contract():
     text, companies = request.json['text'], request.json['companies']
+    creation_date = datetime.now()
     document = {
         'text': text, 'companies': companies,
-        'creation_date': datetime.now().strftime('%d.%m.%y %H:%M:%S'), 'status': utils.create_initial_status(companies)
+        'creation_date': creation_date, 'status': utils.create_initial_status(companies), 'revision': 0,
+        'comments_revision': 0, 'versions_revision': 0, 'status_changed_date': creation_date
         }
     inserted_id = mongo.insert_one_document('contract', document) or False
+    if inserted_id:
+        search.index_contract(inserted_id, text, companies)
+        dashboard.change_contract_counts([company['id'] for company in companies], 'creating', 1)
     return jsonify(inserted_id), 201
 
 
@@ -441,27 +688,30 @@ def create_dialog():
     data = request.json
     contract_id, user_id, user_name, message_text, recipient = \
         data['contractId'], data['userId'], data['userName'], data['messageText'], data['recipient']
+    contract = find_contract(contract_id, {'companies': True})
     if recipient == 'everybody':
-        contract = mongo.find_one_document('contract', {'_id': ObjectId(contract_id)})
-        participants = []
-        for company in contract['companies']:
-            company_employees = mongo.find_documents('employee', {'company_id': company['id']})
-            participants.extend(list(company_employees))
+        companies_id = [company['id'] for company in contract['companies']]
+        employees_query = {'company_id': {'$in': companies_id}}
+        participants = mongo.find_documents('employee', employees_query, projection={'name': True})
     else:
-        queries = [{'_id': ObjectId(id)} for id in [user_id, recipient]]
-        participants = mongo.find_documents_under_operator('employee', 'or', queries)
+        employees = mongo.find_by_ids('employee', [user_id, recipient], {'name': True})
+        participants = [employees[employee_id] for employee_id in dict.fromkeys([user_id, recipient])
+                        if employee_id in employees]
     dialog_participants = []
     for participant in participants:
         participant_entities = {'id': str(participant['_id']), 'name': participant['name']}
         dialog_participants.append(participant_entities)
-    dialog = {'contract_id': contract_id, 'participants': dialog_participants}
-    dialog_id = mongo.insert_one_document('dialog', dialog)
     message_sender = {'id': user_id, 'name': user_name}
-    dialog_participants.remove(message_sender)
-    is_read = {participant['id']: False for participant in dialog_participants}
-    message = {'dialog_id': dialog_id, 'text': message_text, 'sender': message_sender,
-               'is_read': is_read, 'creation_date': datetime.now().strftime('%d.%m.%y %H:%M:%S')}
+    unread_by = [participant['id'] for participant in dialog_participants if participant['id'] != user_id]
+    message = {'_id': ObjectId(), 'text': message_text, 'sender': message_sender,
+               'unread_by': unread_by, 'read_by': [], 'creation_date': datetime.now()}
+    dialog = {'contract_id': contract_id, 'participants': dialog_participants, 'revision': 0,
+              'last_message': utils.create_message_summary(message)}
+    message['dialog_id'] = mongo.insert_one_document('dialog', dialog)
     mongo.insert_one_document('message', message)
+    counters.change_counters(unread_by, 'messages')
+    counters.change_counters([participant['id'] for participant in dialog_participants], 'dialogs_revision')
+    search.index_message(message, dialog)
     return jsonify('Created'), 201
 
 
@@ -470,11 +720,14 @@ def create_invitations():
     data = request.json
     contract_id, type, creator_id, recipients_company_id = \
         data['contractId'], data['reason'], data['senderId'], data['company']
-    creator = mongo.find_one_document('employee', {'_id': ObjectId(creator_id)})
+    find_contract(contract_id, {'_id': True})
+    creator = cache.find_employee(creator_id)
+    invitation_recipients = find_invitation_recipients(type, recipients_company_id)
     creator_name, creator_company_id = creator['name'], creator['company_id']
-    creator_company_name = mongo.find_one_document('company', {'_id': ObjectId(creator_company_id)})['name']
-    recipients_company_name = mongo.find_one_document('company', {'_id': ObjectId(recipients_company_id)})['name']
-    creation_date = datetime.now().strftime('%d.%m.%y %H:%M:%S')
+    companies = cache.find_companies([creator_company_id, recipients_company_id])
+    creator_company_name = companies[creator_company_id]['name']
+    recipients_company_name = companies[recipients_company_id]['name']
+    creation_date = datetime.now()
     invitation = {
         'contract_id': contract_id, 'status': 'pending', 'creation_date': creation_date, 'type': type,
         'creator':
@@ -489,16 +742,14 @@ def create_invitations():
             },
     }
     if type == 'signing':
-        director_role = mongo.find_one_document('role', {'name': 'director'})
-        director_role_id = str(director_role['_id'])
-        query = {'company_id': recipients_company_id, 'role_id': director_role_id}
-        recipient = mongo.find_one_document('employee', query)
+        recipient = invitation_recipients[0]
         recipient_id, recipient_name = str(recipient['_id']), recipient['name']
         invitation['recipient'].update({'id': recipient_id, 'name': recipient_name})
         mongo.insert_one_document('invitation', invitation)
+        counters.change_counters([recipient_id], 'invitations')
+        dashboard.change_invitation_counts(recipients_company_id, type, 1)
         return jsonify('Created'), 201
     invitations = []
-    invitation_recipients = mongo.find_documents('employee', {'company_id': recipients_company_id})
     notification_recipients = []
     for recipient in invitation_recipients:
         recipient_id, recipient_name, recipient_email = str(recipient['_id']), recipient['name'], recipient['email']
@@ -507,6 +758,8 @@ def create_invitations():
         invitations.append(invitation_copy)
         notification_recipients.append({'id': recipient_id, 'email': recipient_email})
     mongo.insert_documents('invitation', invitations)
+    counters.change_counters([recipient['id'] for recipient in notification_recipients], 'invitations')
+    dashboard.change_invitation_counts(recipients_company_id, type, len(invitations))
     if type == 'editing':
         create_notifications(contract_id, notification_recipients, 'editing')
     return jsonify('Created'), 201
@@ -516,11 +769,22 @@ def create_invitations():
 def create_message():
     dialog_id, text, sender_id, sender_name = request.json['dialogId'], request.json['messageText'], \
                                               request.json['sender']['id'], request.json['sender']['name']
-    dialog = mongo.find_one_document('dialog', {'_id': ObjectId(dialog_id)})
-    is_read = {participant['id']: False for participant in dialog['participants'] if participant['id'] != sender_id}
+    dialog_projection = {'contract_id': True, 'participants': True}
+    dialog = mongo.find_one_document('dialog', {'_id': ObjectId(dialog_id)}, dialog_projection)
+    if not dialog:
+        abort(404)
+    find_contract(dialog['contract_id'], {'_id': True})
+    unread_by = [participant['id'] for participant in dialog['participants'] if participant['id'] != sender_id]
     message = {'dialog_id': dialog_id, 'text': text, 'sender': {'id': sender_id, 'name': sender_name},
-               'is_read': is_read, 'creation_date': datetime.now().strftime('%d.%m.%y %H:%M:%S')}
+               'unread_by': unread_by, 'read_by': [], 'creation_date': datetime.now()}
     mongo.insert_one_document('message', message)
+    query = {'_id': ObjectId(dialog_id), '$or': [{'last_message.creation_date': {'$lte': message['creation_date']}},
+                                                 {'last_message': {'$exists': False}}]}
+    dialog_update = {'$set': {'last_message': utils.create_message_summary(message)}, '$inc': {'revision': 1}}
+    mongo.update_one_by_query('dialog', query, dialog_update)
+    counters.change_counters(unread_by, 'messages')
+    counters.change_counters([participant['id'] for participant in dialog['participants']], 'dialogs_revision')
+    search.index_message(message, dialog)
     return jsonify('Created'), 201
 
 
@@ -528,91 +792,108 @@ def create_message():
 def update_comment():
     contract_id, author, number, text = request.json['contractId'], request.json['userName'], \
                                         request.json['commentNumber'], request.json['responseText']
-    comment = mongo.find_one_document('comment', {'contract_id': contract_id, 'number': number})
-    ids = [related_comment['id'] for related_comment in comment['related_comments']]
-    id = max(*ids) + 1 if len(ids) > 1 else ids[0] + 1
-    new_related_comment = {'id': id, 'author': author, 'text': text,
-                           'creation_date': datetime.now().strftime('%d.%m.%y %H:%M:%S')}
-    comment['related_comments'].append(new_related_comment)
-    mongo.update_one_document('comment', str(comment['_id']), comment)
-    return jsonify('Updated')
+    find_contract(contract_id, {'_id': True})
+    for attempt in range(utils.update_attempts):
+        comment_query = {'contract_id': contract_id, 'number': number}
+        comment = mongo.find_one_document('comment', comment_query, {'related_comments.id': True})
+        id = max(related_comment['id'] for related_comment in comment['related_comments']) + 1
+        new_related_comment = {'id': id, 'author': author, 'text': text,
+                               'creation_date': datetime.now()}
+        id_guard_query = {'_id': comment['_id'], 'related_comments.id': {'$ne': id}}
+        if mongo.update_one_by_query('comment', id_guard_query, {'$push': {'related_comments': new_related_comment}}):
+            bump_comments_revision(contract_id)
+            search.index_comment(contract_id, number)
+            return jsonify('Updated')
+    return jsonify('Conflict'), 409
 
 
 @app.route('/contract/update', methods=['PUT'])
 def update_contract():
-    contract_id, new_text = request.json['id'], request.json['text']
-    contract = mongo.find_one_document('contract', {'_id': ObjectId(contract_id)})
-    contract = json.loads(utils.convert_mongo_data_to_json(contract))
-    del contract['_id']
-    contract['text'] = new_text
-    if not request.json.get('onlyText'):
-        types_map = {'harmonization': 'harmonization', 'harmonized': 'signing', 'signing': 'signing'}
-        invitation_type_to_delete = types_map.get(contract['status']['name'])
-        if invitation_type_to_delete:
-            mongo.delete_many_documents('invitation', {'contract_id': contract_id, 'type': invitation_type_to_delete})
-        mongo.delete_many_documents('comment', {'contract_id': contract_id})
-        contract['status'] = utils.create_initial_status(contract['companies'])
-    mongo.update_one_document('contract', contract_id, contract)
-    return jsonify('Updated')
+    contract_id = request.json['id']
+    new_text, text_patch = get_contract_text_change(contract_id, request.json, 'text')
+    if request.json.get('onlyText'):
+        revision = update_contract_text(contract_id, new_text, text_patch=text_patch)
+        return jsonify({'revision': revision} if text_patch else 'Updated')
+    contract_projection = {'companies': True, 'status.name': True, 'status_changed_date': True}
+    contract = find_contract(contract_id, contract_projection)
+    contract_fields = {'status': utils.create_initial_status(contract['companies'])}
+    status_changed_date, status_name = datetime.now(), contract['status']['name']
+    if status_name != 'creating':
+        contract_fields['status_changed_date'] = status_changed_date
+    revision = update_contract_text(contract_id, new_text, contract_fields, text_patch)
+    if status_name != 'creating':
+        dashboard.record_status_change([company['id'] for company in contract['companies']], status_name, 'creating',
+                                       contract.get('status_changed_date'), status_changed_date)
+    types_map = {'harmonization': 'harmonization', 'harmonized': 'signing', 'signing': 'signing'}
+    invitation_type_to_delete = types_map.get(status_name)
+    if invitation_type_to_delete:
+        invitations_query = {'contract_id': contract_id, 'type': invitation_type_to_delete}
+        counters.discount_items('invitations', invitations_query)
+        dashboard.discount_invitations(invitations_query)
+        mongo.delete_many_documents('invitation', invitations_query)
+    mongo.delete_many_documents('comment', {'contract_id': contract_id})
+    bump_comments_revision(contract_id)
+    search.remove_comments(contract_id)
+    return jsonify({'revision': revision} if text_patch else 'Updated')
 
 
 @app.route('/employees/roles/update', methods=['PUT'])
 def update_employees_roles():
+    roles = cache.find_roles_by_names([employee_info['selectedRole'] for employee_info in request.json])
+    operations = []
     for employee_info in request.json:
         employee_id, new_role = employee_info['employeeId'], employee_info['selectedRole']
-        employee = mongo.find_one_document('employee', {'_id': ObjectId(employee_id)})
-        employee['role_id'] = str(mongo.find_one_document('role', {'name': new_role})['_id'])
-        mongo.update_one_document('employee', employee_id, employee)
+        role_id = str(roles[new_role]['_id'])
+        operations.append(UpdateOne({'_id': ObjectId(employee_id)}, {'$set': {'role_id': role_id}}))
+    mongo.bulk_write('employee', operations, ordered=False)
+    for employee_info in request.json:
+        cache.invalidate_employee(employee_info['employeeId'])
     return jsonify('Updated')
 
 
 @app.route('/comment/delete', methods=['DELETE'])
 def delete_comment():
-    contract_id, new_contract_text, number, id = request.json['contractId'], request.json['contractTextAfterRemoval'], \
-                                                 request.json['number'], request.json['id']
-    comment = mongo.find_one_document('comment', {'contract_id': contract_id, 'number': number})
-    updated_related_comments = [comment for comment in comment['related_comments'] if comment['id'] != id]
-    if updated_related_comments:
-        comment['related_comments'] = updated_related_comments
-        mongo.update_one_document('comment', str(comment['_id']), comment)
+    contract_id, number, id = request.json['contractId'], request.json['number'], request.json['id']
+    find_contract(contract_id, {'_id': True})
+    new_contract_text, text_patch = get_contract_text_change(contract_id, request.json, 'contractTextAfterRemoval')
+    comment = mongo.find_one_and_update('comment', {'contract_id': contract_id, 'number': number},
+                                        {'$pull': {'related_comments': {'id': id}}}, {'related_comments.id': True},
+                                        return_updated=True)
+    if comment['related_comments']:
+        bump_comments_revision(contract_id)
+        search.index_comment(contract_id, number)
         return jsonify('Updated')
-    mongo.delete_one_document('comment', {'contract_id': contract_id, 'number': number})
-    contract = mongo.find_one_document('contract', {'_id': ObjectId(contract_id)})
-    contract['text'] = new_contract_text
-    mongo.update_one_document('contract', contract_id, contract)
-    return jsonify('Deleted')
+    mongo.delete_one_document('comment', {'_id': comment['_id'], 'related_comments': {'$size': 0}})
+    revision = update_contract_text(contract_id, new_contract_text, text_patch=text_patch)
+    bump_comments_revision(contract_id)
+    search.remove_comments(contract_id, number)
+    return jsonify({'revision': revision} if text_patch else 'Deleted')
 
 
 @app.route('/contract/delete/<contract_id>', methods=['DELETE'])
 def delete_contract(contract_id):
-    mongo.delete_one_document('contract', {'_id': ObjectId(contract_id)})
-    mongo.delete_many_documents('comment', {'contract_id': contract_id})
-    mongo.delete_many_documents('invitation', {'contract_id': contract_id})
-    mongo.delete_many_documents('notification', {'contract_id': contract_id})
-    mongo.delete_many_documents('version', {'contract_id': contract_id})
-    dialogs = mongo.find_documents('dialog', {'contract_id': contract_id})
-    dialogs_id = [str(dialog['_id']) for dialog in dialogs]
-    mongo.delete_many_documents('dialog', {'contract_id': contract_id})
-    mongo.delete_many_documents('message', {'dialog_id': {'$in': dialogs_id}})
+    if deletion.mark_deleted(contract_id):
+        purge_contract.delay(contract_id)
     return jsonify('Deleted')
 
 
 @app.route('/contract/version/delete/<version_id>', methods=['DELETE'])
 def delete_contract_version(version_id):
-    mongo.delete_one_document('version', {'_id': ObjectId(version_id)})
+    version = mongo.find_one_document('version', {'_id': ObjectId(version_id)}, {'contract_id': True})
+    if version:
+        find_contract(version['contract_id'], {'_id': True})
+    versions.delete_version(version_id)
     return jsonify('Deleted')
 
 
+def bump_comments_revision(contract_id):
+    mongo.update_one_by_query('contract', {'_id': ObjectId(contract_id)}, {'$inc': {'comments_revision': 1}})
+
+
 def create_notifications(contract_id, notification_recipients: list, type):
-    creation_date = datetime.now().strftime('%d.%m.%y %H:%M:%S')
-    text_map = {
-        'editing': 'Invitation to editing contract was received',
-        'harmonization': 'Contract needs a harmonization for changing its status to "harmonized"',
-        'signing': 'Contract is harmonized and needs to be signed for changing its status to "signed"',
-        'archived': 'Contract is archived'
-    }
+    creation_date = datetime.now()
     notification = {'contract_id': contract_id, 'creation_date': creation_date, 'is_read': False, 'type': type,
-                    'text': text_map[type]}
+                    'text': utils.notification_texts[type]}
     notifications = []
     recipient_emails = []
     for recipient in notification_recipients:
@@ -621,8 +902,84 @@ def create_notifications(contract_id, notification_recipients: list, type):
         notifications.append(notification_copy)
         recipient_emails.append(recipient['email'])
     mongo.insert_documents('notification', notifications)
-    send_email_notification.delay(contract_id, text_map[type], recipient_emails)
+    counters.change_counters([recipient['id'] for recipient in notification_recipients], 'notifications')
+    send_email_notification.delay(contract_id, utils.notification_texts[type], recipient_emails)
+
+
+def get_contract_revision(contract_id):
+    return find_contract(contract_id, {'revision': True}).get('revision')
+
+
+def export_documents(collection_name, query, projection=None):
+    since = request.args.get('since')
+    if since:
+        since_date = mongo.parse_date(since)
+        if since_date is None:
+            abort(400)
+        query = {**query, 'updated_date': {'$gte': since_date}}
+    sort = [('updated_date', mongo.ASC), ('_id', mongo.ASC)]
+    documents = mongo.find_documents(collection_name, query, sort, projection=projection,
+                                     batch_size=utils.export_batch_size)
+    lines = (json.dumps(document) + '\n' for document in documents)
+    return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+
+
+def find_contract(contract_id, projection=None):
+    contract = mongo.find_one_document('contract', {'_id': ObjectId(contract_id), **deletion.live_contract_query},
+                                       projection)
+    if not contract:
+        abort(404)
+    return contract
+
+
+def find_invitation_recipients(type, company_id):
+    if type == 'signing':
+        director_role_id = str(cache.find_role_by_name('director')['_id'])
+        return [mongo.find_one_document('employee', {'company_id': company_id, 'role_id': director_role_id})]
+    return list(mongo.find_documents('employee', {'company_id': company_id}, projection={'name': True, 'email': True}))
+
+
+def get_contract_revisions(contract_id, *revision_names):
+    return find_contract(contract_id, {revision_name: True for revision_name in revision_names})
+
+
+def get_contract_text_change(contract_id, data, text_field):
+    text_patch = data.get('textPatch')
+    if not text_patch:
+        return data[text_field], None
+    if not utils.is_valid_text_patch(text_patch):
+        abort(400)
+    contract = find_contract(contract_id, {'text': True, 'revision': True})
+    if contract.get('revision') != text_patch['baseRevision']:
+        raise RevisionConflict(contract.get('revision'))
+    try:
+        return utils.apply_text_patch(contract['text'], text_patch['ops']), text_patch
+    except (TypeError, ValueError):
+        abort(400)
+
+
+def is_not_modified(*etag_parts):
+    g.etag = hashlib.sha1(repr((request.full_path, etag_parts)).encode()).hexdigest()
+    return g.etag in request.if_none_match
+
+
+def update_contract_text(contract_id, contract_text, contract_fields=None, text_patch=None):
+    contract_fields = {**(contract_fields or {}), 'text': contract_text,
+                       'comment_anchors': utils.find_comment_anchors(contract_text)}
+    if not text_patch:
+        query = {'_id': ObjectId(contract_id), **deletion.live_contract_query}
+        if not mongo.update_one_by_query('contract', query, {'$set': contract_fields, '$inc': {'revision': 1}}):
+            abort(404)
+        revision = None
+    else:
+        base_revision = text_patch['baseRevision']
+        if not mongo.update_with_revision('contract', contract_id, base_revision, {'$set': contract_fields}):
+            raise RevisionConflict(get_contract_revision(contract_id))
+        revision = (base_revision or 0) + 1
+    search.index_contract(contract_id, contract_text)
+    return revision
 
 
 if __name__ == '__main__':
+    mongo.ensure_indexes()
     app.run(debug=True)
@@ -0,0 +1,328 @@
+import cache
+import click
+import dashboard
+import json
+import mongo
+import re
+import seeding
+import time
+import timeit
+import urllib.error
+import urllib.parse
+import urllib.request
+import utils
+import versions
+from bson import ObjectId
+from celery.app.task import Task
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from flask import current_app, jsonify
+from flask.cli import AppGroup
+from unittest import mock
+
+
+benchmark_cli = AppGroup('benchmark', help='Measures hot code paths on synthetic data.')
+# flask benchmark seed --contracts 10000 --drop
+# flask benchmark routes --requests 50 --output before.json
+# flask benchmark routes --url http://127.0.0.1:5000 --concurrency 16 --output after.json
+# flask benchmark json-encoding --contracts 1000 --repeat 20
+# flask benchmark load --url http://127.0.0.1:5000 --path /contract/<id>/<employee_id> --requests 2000 --concurrency 32
+# Mongo ops per request are read from /metrics, which only counts the process that answers it: with --url they are
+# right for a single-process server only (e.g. `flask run` or gunicorn --workers 1).
+metrics_line_pattern = re.compile(r'^mongo_commands_total\{method="([^"]*)",route="([^"]*)"\} (\S+)$', re.MULTILINE)
+bench_comment_number = 1000
+updated_comment_number = 2000
+deleted_comment_number = 3000
+
+
+@benchmark_cli.command('seed')
+@click.option('--contracts', default=10000, show_default=True)
+@click.option('--companies', default=0, help='Defaults to one company per 200 contracts, at least 4.')
+@click.option('--text-length', default=3000, show_default=True, help='Mean characters of text per contract.')
+@click.option('--max-messages', default=2000, show_default=True, help='Longest dialog history.')
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--seed', 'seed_value', default=1, show_default=True)
+@click.option('--drop', is_flag=True, help='Drop the seeded collections first.')
+def seed_command(contracts, companies, text_length, max_messages, batch_size, seed_value, drop):
+    if drop:
+        seeding.drop_seeded_collections()
+    companies = companies or max(4, contracts // 200)
+    totals = seeding.seed(contracts, companies, text_length, max_messages, batch_size, seed_value, report_seeding)
+    click.echo(json.dumps(totals))
+
+
+@benchmark_cli.command('routes')
+@click.option('--url', default=None, help='Base URL of a running server, the Flask test client is used without it. '
+                                        'Mongo ops per request are only right for a single-process server.')
+@click.option('--requests', 'requests_count', default=50, show_default=True, help='Requests per route.')
+@click.option('--concurrency', default=1, show_default=True, help='Concurrent requests, used with --url.')
+@click.option('--route', 'routes', multiple=True, help='Only run these routes, can be repeated.')
+@click.option('--output', type=click.File('w'), default='-', help='File for the JSON report.')
+def routes_command(url, requests_count, concurrency, routes, output):
+    send = create_sender(url)
+    context = create_bench_context()
+    report = {'mode': 'http' if url else 'test-client', 'requests': requests_count,
+              'concurrency': concurrency if url else 1, 'routes': {}}
+    # Without a server there is no broker to publish Celery tasks to. Deleted contracts are then purged later by
+    # the resume-contract-purges beat task.
+    skipped_publishing = nullcontext() if url else mock.patch.object(Task, 'apply_async')
+    with skipped_publishing:
+        try:
+            run_scenarios(send, context, routes, requests_count, report)
+        finally:
+            send('DELETE', f"/contract/delete/{context['contract_id']}", None)
+    output.write(json.dumps(report, indent=2) + '\n')
+
+
+def run_scenarios(send, context, routes, requests_count, report):
+    for name, method, path, body, prepare in create_scenarios(context):
+        if routes and name not in routes:
+            continue
+        if prepare:
+            prepare(requests_count)
+        commands_before = scrape_mongo_commands(send)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(report['concurrency']) as executor:
+            results = list(executor.map(
+                lambda number: measure(send, method, call(path, number), call(body, number)),
+                range(requests_count)))
+        elapsed = time.perf_counter() - started
+        commands_count = scrape_mongo_commands(send) - commands_before
+        route_report = summarize([seconds for seconds, _, _ in results], elapsed,
+                                 sum(status >= 400 for _, status, _ in results))
+        route_report['mongo_ops_per_request'] = round(commands_count / requests_count, 2)
+        report['routes'][name] = route_report
+        click.echo(f"{name}: p50 {route_report['p50_ms']}ms, p99 {route_report['p99_ms']}ms", err=True)
+
+
+@benchmark_cli.command('json-encoding')
+@click.option('--contracts', default=1000, show_default=True, help='Contracts in the encoded payload.')
+@click.option('--repeat', default=20, show_default=True)
+def json_encoding_command(contracts, repeat):
+    payload = {'currentPage': 1, 'pagesCount': 1, 'records': create_contracts(contracts), 'nextCursor': None}
+    timings = {
+        'round trip': min(timeit.repeat(lambda: jsonify(json.loads(json.dumps(payload, default=str))),
+                                        number=1, repeat=repeat)),
+        'provider': min(timeit.repeat(lambda: jsonify(payload), number=1, repeat=repeat)),
+    }
+    for path, seconds in timings.items():
+        click.echo(f'{path}: {seconds * 1000:.2f} ms for {contracts} contracts')
+    click.echo(f"speedup: {timings['round trip'] / timings['provider']:.2f}x")
+
+
+@benchmark_cli.command('load')
+@click.option('--url', default='http://127.0.0.1:5000', show_default=True, help='Base URL of a running server.')
+@click.option('--path', 'paths', multiple=True, required=True, help='GET path to request, can be repeated.')
+@click.option('--requests', 'requests_count', default=1000, show_default=True)
+@click.option('--concurrency', default=16, show_default=True)
+def load_command(url, paths, requests_count, concurrency):
+    send = create_sender(url)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(lambda number: measure(send, 'GET', paths[number % len(paths)], None),
+                                    range(requests_count)))
+    elapsed = time.perf_counter() - started
+    report = summarize([seconds for seconds, _, _ in results], elapsed, sum(status >= 400 for _, status, _ in results))
+    click.echo(json.dumps({**report, 'concurrency': concurrency}))
+
+
+def call(value, number):
+    return value(number) if callable(value) else value
+
+
+def create_bench_context():
+    sample = next(mongo.find_documents('contract', {}, [('_id', mongo.DESC)], 1), None)
+    if not sample:
+        raise click.ClickException('No contracts found, run `flask benchmark seed` first')
+    company_id, other_company_id = sample['companies'][0]['id'], sample['companies'][1]['id']
+    employee = mongo.find_one_document('employee', {'company_id': company_id})
+    other_employee = mongo.find_one_document('employee', {'company_id': other_company_id})
+    employee_id, other_employee_id = str(employee['_id']), str(other_employee['_id'])
+    sender = {'id': employee_id, 'name': employee['name']}
+    now = datetime.now()
+    contract_id = create_bench_contract(sample['text'], sample['companies'])
+    message = {'_id': ObjectId(), 'text': 'Benchmark message', 'sender': sender, 'unread_by': [other_employee_id],
+               'read_by': [], 'creation_date': now}
+    dialog = {'contract_id': contract_id, 'revision': 0, 'last_message': utils.create_message_summary(message),
+              'participants': [sender, {'id': other_employee_id, 'name': other_employee['name']}]}
+    message['dialog_id'] = mongo.insert_one_document('dialog', dialog)
+    mongo.insert_one_document('message', message)
+    invitation = {'contract_id': contract_id, 'status': 'accepted', 'creation_date': now, 'type': 'harmonization',
+                  'creator': {'id': other_employee_id, 'name': other_employee['name'],
+                              'company_id': other_company_id, 'company_name': sample['companies'][1]['name']},
+                  'recipient': {'id': employee_id, 'name': employee['name'], 'company_id': company_id,
+                                'company_name': sample['companies'][0]['name']}}
+    notification = {'contract_id': contract_id, 'recipient_id': employee_id, 'creation_date': now, 'is_read': True,
+                    'type': 'archived', 'text': utils.notification_texts['archived']}
+    return {
+        'contract_id': contract_id, 'text': sample['text'], 'companies': sample['companies'],
+        'employee_id': employee_id, 'employee_name': employee['name'], 'other_company_id': other_company_id,
+        'other_employee_id': other_employee_id, 'role_name': cache.find_role(employee['role_id'])['name'],
+        'dialog_id': message['dialog_id'], 'invitation_id': mongo.insert_one_document('invitation', invitation),
+        'notification_id': mongo.insert_one_document('notification', notification),
+        'version_id': versions.save_version(contract_id, employee_id, sample['text'], now, 'creating'),
+        'since': (now - timedelta(days=1)).isoformat(),
+    }
+
+
+def create_bench_contract(text, companies: list):
+    now = datetime.now()
+    contract = {'text': text, 'companies': companies, 'creation_date': now,
+                'status': utils.create_initial_status(companies), 'revision': 0, 'comments_revision': 0,
+                'versions_revision': 0, 'comment_anchors': utils.find_comment_anchors(text), 'status_changed_date': now}
+    contract_id = mongo.insert_one_document('contract', contract)
+    dashboard.change_contract_counts([company['id'] for company in companies], 'creating', 1)
+    return contract_id
+
+
+def create_bench_comments(contract_id, first_number, comments_count):
+    mongo.insert_documents('comment', [
+        {'contract_id': contract_id, 'number': first_number + number,
+         'related_comments': [{'id': 0, 'author': 'Benchmark', 'text': 'Benchmark comment',
+                               'creation_date': datetime.now()}]}
+        for number in range(comments_count)])
+
+
+def create_scenarios(context):
+    contract_id, employee_id = context['contract_id'], context['employee_id']
+    contract_and_employee = f'{contract_id}/{employee_id}'
+    list_arguments = 'contract_id=undefined&page=1&per_page=10&field=undefined&reverse=undefined'
+    # Scenarios that delete or update existing items create their own fixtures, so any of them can run alone
+    deleted_contracts_id, deleted_versions_id = [], []
+
+    def create_updated_comment(requests_count):
+        create_bench_comments(contract_id, updated_comment_number, 1)
+
+    def create_deleted_contracts(requests_count):
+        deleted_contracts_id[:] = [create_bench_contract(context['text'], context['companies'])
+                                   for _ in range(requests_count)]
+
+    def create_deleted_versions(requests_count):
+        deleted_versions_id[:] = [versions.save_version(contract_id, employee_id, context['text'], datetime.now(),
+                                                        'creating') for _ in range(requests_count)]
+
+    return [
+        ('change_invitation_status', 'GET', f"/invitation/change/{context['invitation_id']}/accepted", None, None),
+        ('check_new_items', 'GET', f'/items/check/{employee_id}', None, None),
+        ('export_contracts', 'GET', f"/export/contracts/{employee_id}?since={context['since']}", None, None),
+        ('export_dialogs', 'GET', f"/export/dialogs/{employee_id}?since={context['since']}", None, None),
+        ('export_invitations', 'GET', f"/export/invitations/{employee_id}?since={context['since']}", None, None),
+        ('export_notifications', 'GET', f"/export/notifications/{employee_id}?since={context['since']}", None,
+         None),
+        ('get_comments', 'GET', f'/comments?contract_id={contract_id}', None, None),
+        ('get_companies', 'GET', f'/companies?user_id={employee_id}', None, None),
+        ('get_contract', 'GET', f'/contract/{contract_and_employee}', None, None),
+        ('get_contracts', 'GET', f'/contracts/{employee_id}?{list_arguments}', None, None),
+        ('get_contract_version', 'GET', f"/contract/version/{context['version_id']}", None, None),
+        ('get_contract_versions', 'GET', f'/contract/versions/{contract_and_employee}', None, None),
+        ('get_dashboard', 'GET', f'/dashboard/{employee_id}', None, None),
+        ('get_dialog_variants', 'GET', f'/dialog/variants/{contract_and_employee}', None, None),
+        ('get_dialog', 'GET', f"/dialog/{context['dialog_id']}/{employee_id}", None, None),
+        ('get_dialogs', 'GET', f'/dialogs/{employee_id}?{list_arguments}', None, None),
+        ('get_employees_roles', 'GET', f'/employees/roles/{employee_id}', None, None),
+        ('get_invitation_variants', 'GET', f'/invitation/variants/{contract_and_employee}', None, None),
+        ('get_invitations', 'GET', f'/invitations/{employee_id}?{list_arguments}', None, None),
+        ('get_metrics', 'GET', '/metrics', None, None),
+        ('get_notifications', 'GET', f'/notifications/{employee_id}?{list_arguments}', None, None),
+        ('search_items', 'GET', f'/search/{employee_id}?q=payment+delivery', None, None),
+        ('get_user', 'GET', f"/user?name={urllib.parse.quote(context['employee_name'])}", None, None),
+        ('make_notification_read', 'GET', f"/notification/read/{context['notification_id']}", None, None),
+        ('save_contract_version', 'GET', f'/contract/version/save/{contract_and_employee}', None, None),
+        ('update_contract_status', 'GET', f'/contract/status/update/{contract_and_employee}?action=Archive', None,
+         None),
+        ('create_comment', 'POST', '/comment/create',
+         lambda number: {'contractId': contract_id, 'contractText': context['text'],
+                         'userName': context['employee_name'], 'text': 'Benchmark comment',
+                         'number': bench_comment_number + number}, None),
+        ('create_contract', 'POST', '/contract/create',
+         {'text': context['text'], 'companies': context['companies']}, None),
+        ('create_dialog', 'POST', '/dialog/create',
+         {'contractId': contract_id, 'userId': employee_id, 'userName': context['employee_name'],
+          'messageText': 'Benchmark dialog', 'recipient': context['other_employee_id']}, None),
+        ('create_invitations', 'POST', '/invitations/create',
+         {'contractId': contract_id, 'reason': 'harmonization', 'senderId': employee_id,
+          'company': context['other_company_id']}, None),
+        ('create_message', 'POST', '/message/create',
+         {'dialogId': context['dialog_id'], 'messageText': 'Benchmark reply',
+          'sender': {'id': employee_id, 'name': context['employee_name']}}, None),
+        ('update_comment', 'PUT', '/comment/update',
+         {'contractId': contract_id, 'userName': context['employee_name'], 'commentNumber': updated_comment_number,
+          'responseText': 'Benchmark reply'}, create_updated_comment),
+        ('update_contract', 'PUT', '/contract/update',
+         {'id': contract_id, 'text': context['text'], 'onlyText': True}, None),
+        ('update_employees_roles', 'PUT', '/employees/roles/update',
+         [{'employeeId': employee_id, 'selectedRole': context['role_name']}], None),
+        ('delete_comment', 'DELETE', '/comment/delete',
+         lambda number: {'contractId': contract_id, 'number': deleted_comment_number + number, 'id': 0,
+                         'contractTextAfterRemoval': context['text']},
+         lambda requests_count: create_bench_comments(contract_id, deleted_comment_number, requests_count)),
+        ('delete_contract', 'DELETE', lambda number: f'/contract/delete/{deleted_contracts_id[number]}', None,
+         create_deleted_contracts),
+        ('delete_contract_version', 'DELETE',
+         lambda number: f'/contract/version/delete/{deleted_versions_id[number]}', None, create_deleted_versions),
+    ]
+
+
+def create_sender(url):
+    if url:
+        return lambda method, path, body: send_http_request(url.rstrip('/') + path, method, body)
+    client = current_app.test_client()
+
+    def send(method, path, body):
+        response = client.open(path, method=method, json=body)
+        return response.status_code, response.get_data()
+    return send
+
+
+def send_http_request(url, method, body):
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(url, data, {'Content-Type': 'application/json'}, method=method)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as error:
+        return error.code, error.read()
+
+
+def measure(send, method, path, body):
+    started = time.perf_counter()
+    status, data = send(method, path, body)
+    return time.perf_counter() - started, status, data
+
+
+def report_seeding(seeded_count, total_count):
+    click.echo(f'{seeded_count}/{total_count} contracts seeded')
+
+
+def scrape_mongo_commands(send):
+    status, data = send('GET', '/metrics', None)
+    return sum(float(count) for _, route, count in metrics_line_pattern.findall(data.decode()) if route != '/metrics')
+
+
+def summarize(latencies: list, elapsed, errors_count):
+    latencies = sorted(latencies)
+    return {'requests': len(latencies), 'errors': errors_count, 'throughput': round(len(latencies) / elapsed, 2),
+            **{f'p{percent}_ms': round(get_percentile(latencies, percent) * 1000, 2) for percent in [50, 95, 99]}}
+
+
+def get_percentile(sorted_values: list, percent):
+    index = min(len(sorted_values) - 1, max(0, round(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def create_contracts(contracts_count):
+    companies = [{'id': str(ObjectId()), 'name': name} for name in ['Zila', 'ABC', 'Zesla Group']]
+    text = '<p>The parties agree to the terms below.</p>'
+    contracts = []
+    for number in range(contracts_count):
+        creation_date = datetime.now() - timedelta(hours=number)
+        status = {**utils.create_initial_status(companies), 'name': 'harmonization'}
+        status['companies'][companies[number % len(companies)]['name']]['lawyer'] = True
+        contract = {'_id': ObjectId(), 'text': text, 'companies': companies, 'creation_date': creation_date,
+                    'status': status, 'revision': number, 'comments_revision': 0, 'versions_revision': 0,
+                    'comment_anchors': utils.find_comment_anchors(text), 'status_changed_date': creation_date,
+                    'updated_date': creation_date}
+        contracts.append({field: value for field, value in contract.items()
+                          if utils.contract_list_projection.get(field, True)})
+    return contracts
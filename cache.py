@@ -0,0 +1,118 @@
+import copy
+import mongo
+import time
+from bson import ObjectId
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache:
+    def __init__(self, max_size, ttl):
+        self.max_size, self.ttl = max_size, ttl
+        self.entries = OrderedDict()
+        self.hits, self.misses = 0, 0
+        self.lock = Lock()
+
+    def get(self, key, load):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry[0])
+            self.misses += 1
+        value = load()
+        if value is not None:
+            with self.lock:
+                self.entries[key] = (value, now + self.ttl)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        return copy.deepcopy(value)
+
+    def get_many(self, keys: list, load_many):
+        now = time.monotonic()
+        values, missing_keys = {}, []
+        with self.lock:
+            for key in dict.fromkeys(keys):
+                entry = self.entries.get(key)
+                if entry and entry[1] > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    values[key] = copy.deepcopy(entry[0])
+                else:
+                    self.misses += 1
+                    missing_keys.append(key)
+        if missing_keys:
+            loaded_values = load_many(missing_keys)
+            with self.lock:
+                for key, value in loaded_values.items():
+                    self.entries[key] = (value, now + self.ttl)
+                    self.entries.move_to_end(key)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+            values.update(copy.deepcopy(loaded_values))
+        return values
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+
+# Caches are per process, so the TTL bounds how long another worker may serve a stale document after a write.
+roles = LRUCache(max_size=64, ttl=600)
+companies = LRUCache(max_size=1024, ttl=600)
+employees = LRUCache(max_size=4096, ttl=60)
+
+
+def find_companies(companies_id: list):
+    return companies.get_many(companies_id, lambda missing_id: mongo.find_by_ids('company', missing_id))
+
+
+def find_company(company_id):
+    return companies.get(company_id, lambda: mongo.find_one_document('company', {'_id': ObjectId(company_id)}))
+
+
+def find_employee(employee_id):
+    return employees.get(employee_id, lambda: mongo.find_one_document('employee', {'_id': ObjectId(employee_id)}))
+
+
+def find_employee_company_and_role(employee_id):
+    employee = find_employee(employee_id)
+    return find_company(employee['company_id'])['name'], find_role(employee['role_id'])['name']
+
+
+def find_role(role_id):
+    return roles.get(role_id, lambda: mongo.find_one_document('role', {'_id': ObjectId(role_id)}))
+
+
+def find_role_by_name(role_name):
+    return roles.get(('name', role_name), lambda: mongo.find_one_document('role', {'name': role_name}))
+
+
+def find_roles(roles_id: list):
+    return roles.get_many(roles_id, lambda missing_id: mongo.find_by_ids('role', missing_id))
+
+
+def find_roles_by_names(roles_name: list):
+    def load_roles(missing_names):
+        found_roles = mongo.find_documents('role', {'name': {'$in': [name for _, name in missing_names]}})
+        return {('name', role['name']): role for role in found_roles}
+    roles_by_names = roles.get_many([('name', role_name) for role_name in roles_name], load_roles)
+    return {role_name: role for (_, role_name), role in roles_by_names.items()}
+
+
+def get_stats():
+    return {'roles': roles.get_stats(), 'companies': companies.get_stats(), 'employees': employees.get_stats()}
+
+
+def invalidate_employee(employee_id=None):
+    employees.invalidate(employee_id)
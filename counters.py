@@ -0,0 +1,53 @@
+import mongo
+from pymongo import UpdateOne
+
+
+counted_items = {
+    'messages': ('message', {'unread_by': {'$exists': True, '$ne': []}}, '$unread_by'),
+    'invitations': ('invitation', {'status': 'pending'}, '$recipient.id'),
+    'notifications': ('notification', {'is_read': False}, '$recipient_id'),
+}
+
+
+def change_counters(employees_id: list, counter_name, amount=1):
+    operations = [UpdateOne({'_id': employee_id}, {'$inc': {counter_name: amount}}, upsert=True)
+                  for employee_id in employees_id]
+    mongo.bulk_write('counter', operations, ordered=False)
+
+
+def count_items(counter_name, query):
+    collection_name, unread_query, recipient_field = counted_items[counter_name]
+    pipeline = [{'$match': {**query, **unread_query}}]
+    if counter_name == 'messages':
+        pipeline.append({'$unwind': recipient_field})
+    pipeline.append({'$group': {'_id': recipient_field, 'count': {'$sum': 1}}})
+    return {group['_id']: group['count'] for group in mongo.aggregate(collection_name, pipeline)}
+
+
+def discount_items(counter_name, query):
+    operations = [UpdateOne({'_id': employee_id}, {'$inc': {counter_name: -count}})
+                  for employee_id, count in count_items(counter_name, query).items()]
+    mongo.bulk_write('counter', operations, ordered=False)
+
+
+def get_dialogs_revision(employee_id):
+    counters = mongo.find_one_document('counter', {'_id': employee_id}, {'dialogs_revision': True}) or {}
+    return counters.get('dialogs_revision', 0)
+
+
+def get_counters(employee_id):
+    counters = mongo.find_one_document('counter', {'_id': employee_id}) or {}
+    return {counter_name: max(counters.get(counter_name, 0), 0) for counter_name in counted_items}
+
+
+def rebuild_counters():
+    counts = {counter_name: count_items(counter_name, {}) for counter_name in counted_items}
+    employees_id = {str(counter['_id']) for counter in mongo.find_documents('counter', {})}
+    for counter_counts in counts.values():
+        employees_id.update(counter_counts)
+    operations = []
+    for employee_id in employees_id:
+        employee_counters = {counter_name: counts[counter_name].get(employee_id, 0) for counter_name in counted_items}
+        operations.append(UpdateOne({'_id': employee_id}, {'$set': employee_counters}, upsert=True))
+    mongo.bulk_write('counter', operations, ordered=False)
+    return len(operations)
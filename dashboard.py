@@ -0,0 +1,79 @@
+import mongo
+from pymongo import UpdateOne
+
+
+contract_statuses = ['creating', 'harmonization', 'harmonized', 'signing', 'signed', 'archived']
+invitation_types = ['editing', 'harmonization', 'signing']
+
+
+def change_contract_counts(companies_id: list, status_name, amount):
+    operations = [UpdateOne({'_id': company_id}, {'$inc': {f'contracts.{status_name}': amount}}, upsert=True)
+                  for company_id in companies_id]
+    mongo.bulk_write('company_stat', operations, ordered=False)
+
+
+def change_invitation_counts(company_id, invitation_type, amount):
+    mongo.bulk_write('company_stat', [UpdateOne({'_id': company_id},
+                                                {'$inc': {f'pending_invitations.{invitation_type}': amount}},
+                                                upsert=True)])
+
+
+def discount_invitations(query):
+    pipeline = [{'$match': {**query, 'status': 'pending'}},
+                {'$group': {'_id': {'company_id': '$recipient.company_id', 'type': '$type'}, 'count': {'$sum': 1}}}]
+    operations = [UpdateOne({'_id': group['_id']['company_id']},
+                            {'$inc': {f"pending_invitations.{group['_id']['type']}": -group['count']}})
+                  for group in mongo.aggregate('invitation', pipeline)]
+    mongo.bulk_write('company_stat', operations, ordered=False)
+
+
+def record_status_change(companies_id: list, old_status_name, new_status_name, entered_date, changed_date):
+    increments = {f'contracts.{old_status_name}': -1, f'contracts.{new_status_name}': 1}
+    if entered_date:
+        increments.update({f'status_time.{old_status_name}.seconds': (changed_date - entered_date).total_seconds(),
+                           f'status_time.{old_status_name}.count': 1})
+    operations = [UpdateOne({'_id': company_id}, {'$inc': increments}, upsert=True) for company_id in companies_id]
+    mongo.bulk_write('company_stat', operations, ordered=False)
+
+
+def get_dashboard(company_id):
+    statistics = mongo.find_one_document('company_stat', {'_id': company_id}) or {}
+    contracts, pending_invitations = statistics.get('contracts', {}), statistics.get('pending_invitations', {})
+    status_time = statistics.get('status_time', {})
+    average_seconds = {}
+    for status_name in contract_statuses:
+        status_totals = status_time.get(status_name)
+        average_seconds[status_name] = status_totals['seconds'] / status_totals['count'] if status_totals else None
+    return {
+        'contractsByStatus': {status_name: max(contracts.get(status_name, 0), 0) for status_name in contract_statuses},
+        'pendingInvitations': {invitation_type: max(pending_invitations.get(invitation_type, 0), 0)
+                               for invitation_type in invitation_types},
+        'averageStatusSeconds': average_seconds,
+    }
+
+
+def rebuild_dashboards():
+    # Tombstoned contracts still count until the statistics stage of their purge has discounted them
+    contracts_pipeline = [
+        {'$match': {'deletion.stage': {'$in': [None, 'statistics']}}},
+        {'$unwind': '$companies'},
+        {'$group': {'_id': {'company_id': '$companies.id', 'status': '$status.name'}, 'count': {'$sum': 1}}},
+    ]
+    invitations_pipeline = [
+        {'$match': {'status': 'pending'}},
+        {'$group': {'_id': {'company_id': '$recipient.company_id', 'type': '$type'}, 'count': {'$sum': 1}}},
+    ]
+    statistics = {str(statistic['_id']): {'contracts': {}, 'pending_invitations': {}}
+                  for statistic in mongo.find_documents('company_stat', {}, projection={'_id': True})}
+    for group in mongo.aggregate('contract', contracts_pipeline):
+        company_statistics = statistics.setdefault(group['_id']['company_id'],
+                                                   {'contracts': {}, 'pending_invitations': {}})
+        company_statistics['contracts'][group['_id']['status']] = group['count']
+    for group in mongo.aggregate('invitation', invitations_pipeline):
+        company_statistics = statistics.setdefault(group['_id']['company_id'],
+                                                   {'contracts': {}, 'pending_invitations': {}})
+        company_statistics['pending_invitations'][group['_id']['type']] = group['count']
+    operations = [UpdateOne({'_id': company_id}, {'$set': company_statistics}, upsert=True)
+                  for company_id, company_statistics in statistics.items()]
+    mongo.bulk_write('company_stat', operations, ordered=False)
+    return len(operations)
@@ -1,7 +1,7 @@
 company = {'id': 1, 'name': 'Green'}
 role = {'name': 'lawyer'} # lawyer or economist or director
 employee = {'name': 'Yura Kotov', 'company_id': 1, 'role_id': 2}
-contract = {'text': 'some text', 'creation_date': '1.1.2021', 'companies': [{'id': 1, 'name': 'Zila'}, {'id': 2, 'name': 'ABC'}],
+contract = {'text': 'some text', 'creation_date': '1.1.2021', 'revision': 0, 'comments_revision': 0, 'versions_revision': 0, 'status_changed_date': '1.1.2021', 'companies': [{'id': 1, 'name': 'Zila'}, {'id': 2, 'name': 'ABC'}],
             'status': {'name': 'creating',
                        'companies': {
                            'id_1': {'lawyer': True,
@@ -17,10 +17,12 @@ invitation = {'contract_id': 1, 'creator': {'id': 1, 'name': 'Liza Kotova', 'com
     {'id': 2, 'name': 'Lex Wom', 'company_id': '', 'company_name': 'BMW'}, 'type': 'editing', 'status': 'accepted', 'creation_date': '05.03.21 23:19'}
 notification = {'contract_id': '1', 'recipient_id': 1, 'creation_date': '05.03.21 23:19', 'is_read': False,
                 'type': 'editing', 'text': 'Invitation to editing contract was received'}
-dialog = {'contract_id': '1',
-          'participants': [{'id': '1', 'name': 'Gustavo'}, {'id': '2', 'name': 'Sonya'}] }
+dialog = {'contract_id': '1', 'revision': 0,
+          'participants': [{'id': '1', 'name': 'Gustavo'}, {'id': '2', 'name': 'Sonya'}],
+          'last_message': {'_id': 1, 'sender': {'id': '1', 'name': 'Gustavo'}, 'text': 'some text',
+                           'creation_date': '1.1.2021', 'unread_by': ['2'], 'read_by': []}}
 message = {'dialog_id': 1, 'sender': {'id': '1', 'name': 'Gustavo'},
-           'text': 'some text', 'is_read': {'2': False}, 'creation_date': '1.1.2021'}
+           'text': 'some text', 'unread_by': ['2'], 'read_by': [], 'creation_date': '1.1.2021'}
 version = {'contract_id': '1', 'creator_id': 1, 'text': 'some text', 'creation_date': '05.03.21 23:19', 'contract_status': 'created'}
 comment = {'contract_id': '1', 'number': 0,
     'related_comments': [
@@ -0,0 +1,100 @@
+import counters
+import dashboard
+import mongo
+from bson import ObjectId
+from datetime import datetime, timedelta
+
+
+# A deleted contract is first marked with a deletion field (the tombstone) and then purged stage by stage by the
+# purge_contract task. Each stage removes at most purge_batch_size documents per batch and records its progress on
+# the tombstone, so a purge interrupted by a dead worker resumes at the stage it stopped at. Counter and dashboard
+# decrements are at most once: the statistics stage is claimed by advancing it before the decrement, and documents
+# that feed counters are claimed with a purge_id so a resumed or duplicate purge never discounts them again.
+purge_batch_size = 500
+purge_stages = ['statistics', 'search_entry', 'invitation', 'notification', 'message', 'dialog', 'comment', 'version',
+                'contract']
+stalled_purge_minutes = 10
+discounted_counters = {'invitation': 'invitations', 'notification': 'notifications', 'message': 'messages'}
+live_contract_query = {'deletion': {'$exists': False}}
+
+
+def mark_deleted(contract_id):
+    query = {'_id': ObjectId(contract_id), **live_contract_query}
+    deletion = {'date': datetime.now(), 'updated_date': datetime.now(), 'stage': purge_stages[0], 'purged': {}}
+    return bool(mongo.update_one_by_query('contract', query, {'$set': {'deletion': deletion}}))
+
+
+def find_deleted_contracts_id(query=None):
+    query = {'deletion.stage': {'$in': purge_stages}, **(query or {})}
+    return [str(contract['_id']) for contract in mongo.find_documents('contract', query, projection={'_id': True})]
+
+
+def exclude_deleted_contracts(query, deleted_contracts_id=None):
+    if deleted_contracts_id is None:
+        deleted_contracts_id = find_deleted_contracts_id()
+    if not deleted_contracts_id:
+        return query
+    return {'$and': [query, {'contract_id': {'$nin': deleted_contracts_id}}]}
+
+
+def find_stalled_purges():
+    stalled_date = datetime.now() - timedelta(minutes=stalled_purge_minutes)
+    return find_deleted_contracts_id({'deletion.updated_date': {'$lt': stalled_date}})
+
+
+def purge_contract(contract_id):
+    contract = mongo.find_one_document('contract', {'_id': ObjectId(contract_id), 'deletion': {'$exists': True}},
+                                       {'companies.id': True, 'status.name': True, 'deletion.stage': True})
+    if not contract:
+        return
+    for stage in purge_stages[purge_stages.index(contract['deletion']['stage']):]:
+        if stage == 'statistics':
+            if advance_stage(contract_id, stage):
+                dashboard.change_contract_counts([company['id'] for company in contract['companies']],
+                                                 contract['status']['name'], -1)
+        elif stage == 'message':
+            dialogs_id = [str(dialog['_id']) for dialog in
+                          mongo.find_documents('dialog', {'contract_id': contract_id}, projection={'_id': True})]
+            purge_documents(contract_id, stage, {'dialog_id': {'$in': dialogs_id}})
+        elif stage == 'contract':
+            mongo.delete_one_document('contract', {'_id': ObjectId(contract_id)})
+        else:
+            purge_documents(contract_id, stage, {'contract_id': contract_id})
+
+
+def purge_documents(contract_id, collection_name, query):
+    purge_id = str(ObjectId())
+    while True:
+        documents = list(mongo.find_documents(collection_name, query, limit=purge_batch_size,
+                                              projection={'participants.id': True}))
+        if not documents:
+            advance_stage(contract_id, collection_name)
+            return
+        batch_query = {'_id': {'$in': [document['_id'] for document in documents]}}
+        if collection_name in discounted_counters:
+            discount_batch(collection_name, batch_query, purge_id)
+        mongo.delete_many_documents(collection_name, batch_query)
+        if collection_name == 'dialog':
+            participants_id = {participant['id'] for document in documents for participant in document['participants']}
+            counters.change_counters(list(participants_id), 'dialogs_revision')
+        record_progress(contract_id, {f'deletion.purged.{collection_name}': len(documents)})
+
+
+def discount_batch(collection_name, batch_query, purge_id):
+    mongo.update_many_documents(collection_name, {**batch_query, 'purge_id': {'$exists': False}},
+                                {'$set': {'purge_id': purge_id}})
+    claimed_query = {**batch_query, 'purge_id': purge_id}
+    counters.discount_items(discounted_counters[collection_name], claimed_query)
+    if collection_name == 'invitation':
+        dashboard.discount_invitations(claimed_query)
+
+
+def advance_stage(contract_id, stage):
+    next_stage = purge_stages[purge_stages.index(stage) + 1]
+    return mongo.update_one_by_query('contract', {'_id': ObjectId(contract_id), 'deletion.stage': stage},
+                                     {'$set': {'deletion.stage': next_stage, 'deletion.updated_date': datetime.now()}})
+
+
+def record_progress(contract_id, increments):
+    mongo.update_one_by_query('contract', {'_id': ObjectId(contract_id)},
+                              {'$inc': increments, '$set': {'deletion.updated_date': datetime.now()}})
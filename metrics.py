@@ -0,0 +1,140 @@
+import cache
+import logging
+import mongo
+import os
+from pymongo import UpdateOne
+from threading import Lock
+
+
+duration_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    def __init__(self, name, help, label_names: list):
+        self.name, self.help, self.label_names = name, help, label_names
+        self.series = {}
+        self.lock = Lock()
+
+    def observe(self, labels: tuple, value):
+        with self.lock:
+            series = self.series.setdefault(labels, {'buckets': [0] * len(duration_buckets), 'sum': 0, 'count': 0})
+            add_observation(series, value)
+
+    def render(self):
+        with self.lock:
+            series = {labels: {**values, 'buckets': list(values['buckets'])} for labels, values in self.series.items()}
+        return render_histogram(self.name, self.help, self.label_names, series)
+
+
+class Counter:
+    def __init__(self, name, help, label_names: list):
+        self.name, self.help, self.label_names = name, help, label_names
+        self.values = {}
+        self.lock = Lock()
+
+    def increase(self, labels: tuple, amount):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(self.label_names, labels)} {value}')
+        return lines
+
+
+request_duration = Histogram('http_request_duration_seconds', 'Request latency by route.', ['method', 'route'])
+mongo_commands = Counter('mongo_commands_total', 'Mongo commands issued by route.', ['method', 'route'])
+mongo_bytes = Counter('mongo_command_bytes_total', 'Mongo command and reply bytes by route.', ['method', 'route'])
+mongo_seconds = Counter('mongo_command_seconds_total', 'Time spent in Mongo commands by route.', ['method', 'route'])
+# Celery workers run in other processes, so task metrics are accumulated in the task_metric collection
+task_histograms = {
+    'duration': ('celery_task_duration_seconds', 'Task run time by task.'),
+    'queue_lag': ('celery_task_queue_lag_seconds', 'Time between publishing and starting a task, by task.'),
+}
+cache_metrics = [
+    ('hits', 'lookup_cache_hits_total', 'counter', 'In-process lookup cache hits by cache.'),
+    ('misses', 'lookup_cache_misses_total', 'counter', 'In-process lookup cache misses by cache.'),
+    ('size', 'lookup_cache_entries', 'gauge', 'Entries held by each in-process lookup cache.'),
+]
+
+
+def add_observation(series, value):
+    for bucket_index, bucket in enumerate(duration_buckets):
+        if value <= bucket:
+            series['buckets'][bucket_index] += 1
+    series['sum'] += value
+    series['count'] += 1
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(label_names: list, labels: tuple, **extra_labels):
+    pairs = [*zip(label_names, labels), *extra_labels.items()]
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+def observe_request(method, route, seconds, command_log):
+    labels = (method, route)
+    request_duration.observe(labels, seconds)
+    totals = command_log.get_totals() if command_log else {'commands': 0, 'bytes': 0, 'seconds': 0}
+    mongo_commands.increase(labels, totals['commands'])
+    mongo_bytes.increase(labels, totals['bytes'])
+    mongo_seconds.increase(labels, totals['seconds'])
+    # SLOW_REQUEST_SECONDS enables the slow-request log: slower requests are logged with their Mongo commands
+    slow_request_seconds = float(os.environ.get('SLOW_REQUEST_SECONDS') or 0)
+    if slow_request_seconds and seconds >= slow_request_seconds:
+        commands = [f"{command['name']} {command['collection']} {command['seconds'] * 1000:.1f}ms "
+                    f"{command['bytes']}B" for command in (command_log.commands if command_log else [])]
+        logger.warning('Slow request %s %s: %.3fs, %d Mongo commands, %d bytes: %s', method, route, seconds,
+                       totals['commands'], totals['bytes'], '; '.join(commands))
+
+
+def observe_task(metric_name, task_name, seconds):
+    increments = {f'buckets.{bucket_index}': 1 for bucket_index, bucket in enumerate(duration_buckets)
+                  if seconds <= bucket}
+    increments.update({'sum': seconds, 'count': 1})
+    operation = UpdateOne({'_id': f'{metric_name}:{task_name}'},
+                          {'$inc': increments, '$setOnInsert': {'metric': metric_name, 'task': task_name}},
+                          upsert=True)
+    mongo.bulk_write('task_metric', [operation])
+
+
+def render():
+    lines = request_duration.render()
+    for counter in [mongo_commands, mongo_bytes, mongo_seconds]:
+        lines.extend(counter.render())
+    task_series = {metric_name: {} for metric_name in task_histograms}
+    for document in mongo.find_documents('task_metric', {}):
+        series = {'buckets': [0] * len(duration_buckets), 'sum': document['sum'], 'count': document['count']}
+        for bucket_index, count in (document.get('buckets') or {}).items():
+            series['buckets'][int(bucket_index)] = count
+        task_series[document['metric']][(document['task'],)] = series
+    for metric_name, (name, help) in task_histograms.items():
+        lines.extend(render_histogram(name, help, ['task'], task_series[metric_name]))
+    lines.extend(render_cache_stats(cache.get_stats()))
+    return '\n'.join(lines) + '\n'
+
+
+def render_histogram(name, help, label_names: list, series: dict):
+    lines = [f'# HELP {name} {help}', f'# TYPE {name} histogram']
+    for labels, values in sorted(series.items()):
+        for bucket, count in zip(duration_buckets, values['buckets']):
+            lines.append(f'{name}_bucket{format_labels(label_names, labels, le=bucket)} {count}')
+        lines.append(f"{name}_bucket{format_labels(label_names, labels, le='+Inf')} {values['count']}")
+        lines.append(f"{name}_sum{format_labels(label_names, labels)} {values['sum']}")
+        lines.append(f"{name}_count{format_labels(label_names, labels)} {values['count']}")
+    return lines
+
+
+def render_cache_stats(stats: dict):
+    lines = []
+    for stat_name, name, type, help in cache_metrics:
+        lines.extend([f'# HELP {name} {help}', f'# TYPE {name} {type}'])
+        for cache_name, cache_stats in sorted(stats.items()):
+            lines.append(f"{name}{format_labels(['cache'], (cache_name,))} {cache_stats[stat_name]}")
+    return lines
@@ -0,0 +1,149 @@
+import click
+import mongo
+import utils
+from bson import Binary, ObjectId
+from flask.cli import AppGroup
+from pymongo import UpdateOne
+
+
+migrate_cli = AppGroup('migrate', help='Migrates stored data to the current schema.')
+# flask migrate dates --batch-size 500
+# flask migrate unread --batch-size 500
+# flask migrate last-messages --batch-size 500
+# flask migrate compress-texts --batch-size 100
+# flask migrate updated-dates --batch-size 500
+
+dated_collections = ['contract', 'version', 'invitation', 'notification', 'message']
+
+
+@migrate_cli.command('dates')
+@click.option('--batch-size', default=500, show_default=True)
+def migrate_dates_command(batch_size):
+    for collection_name in dated_collections:
+        converted_count, skipped_ids = migrate_collection_dates(collection_name, batch_size)
+        report_migration(collection_name, converted_count, skipped_ids)
+    converted_count, skipped_ids = migrate_comments_dates(batch_size)
+    report_migration('comment', converted_count, skipped_ids)
+
+
+def migrate_collection_dates(collection_name, batch_size):
+    converted_count, skipped_ids = 0, []
+    query = {'creation_date': {'$type': 'string'}}
+    for documents in mongo.find_batches(collection_name, query, batch_size, {'creation_date': True}):
+        operations = []
+        for document in documents:
+            creation_date = mongo.parse_date(document['creation_date'])
+            if not creation_date:
+                skipped_ids.append(str(document['_id']))
+                continue
+            operations.append(UpdateOne({'_id': document['_id']}, {'$set': {'creation_date': creation_date}}))
+        mongo.bulk_write(collection_name, operations, ordered=False)
+        converted_count += len(operations)
+    return converted_count, skipped_ids
+
+
+def migrate_comments_dates(batch_size):
+    converted_count, skipped_ids = 0, []
+    query = {'related_comments.creation_date': {'$type': 'string'}}
+    for comments in mongo.find_batches('comment', query, batch_size, {'related_comments': True}):
+        operations = []
+        for comment in comments:
+            related_comments = [mongo.encode_dates(related_comment) for related_comment in comment['related_comments']]
+            if any(isinstance(related_comment['creation_date'], str) for related_comment in related_comments):
+                skipped_ids.append(str(comment['_id']))
+                continue
+            operations.append(UpdateOne({'_id': comment['_id']}, {'$set': {'related_comments': related_comments}}))
+        mongo.bulk_write('comment', operations, ordered=False)
+        converted_count += len(operations)
+    return converted_count, skipped_ids
+
+
+@migrate_cli.command('unread')
+@click.option('--batch-size', default=500, show_default=True)
+def migrate_unread_command(batch_size):
+    converted_count = 0
+    query = {'is_read': {'$exists': True}}
+    for messages in mongo.find_batches('message', query, batch_size, {'is_read': True}):
+        operations = []
+        for message in messages:
+            unread_by = [employee_id for employee_id, is_read in message['is_read'].items() if not is_read]
+            read_by = [employee_id for employee_id, is_read in message['is_read'].items() if is_read]
+            update = {'$set': {'unread_by': unread_by, 'read_by': read_by}, '$unset': {'is_read': ''}}
+            operations.append(UpdateOne({'_id': message['_id']}, update))
+        mongo.bulk_write('message', operations, ordered=False)
+        converted_count += len(operations)
+    report_migration('message', converted_count, [])
+
+
+@migrate_cli.command('last-messages')
+@click.option('--batch-size', default=500, show_default=True)
+def migrate_last_messages_command(batch_size):
+    converted_count = 0
+    query = {'last_message': {'$exists': False}}
+    for dialogs in mongo.find_batches('dialog', query, batch_size, {'_id': True}):
+        dialogs_id = [str(dialog['_id']) for dialog in dialogs]
+        pipeline = [
+            {'$match': {'dialog_id': {'$in': dialogs_id}}},
+            {'$sort': {'creation_date': mongo.DESC}},
+            {'$group': {'_id': '$dialog_id', 'message': {'$first': '$$ROOT'}}},
+        ]
+        operations = []
+        for latest_message in mongo.aggregate('message', pipeline):
+            last_message = utils.create_message_summary(latest_message['message'])
+            dialog_query = {'_id': ObjectId(latest_message['_id'])}
+            operations.append(UpdateOne(dialog_query, {'$set': {'last_message': last_message}}))
+        mongo.bulk_write('dialog', operations, ordered=False)
+        converted_count += len(operations)
+    report_migration('dialog', converted_count, [])
+
+
+@migrate_cli.command('compress-texts')
+@click.option('--batch-size', default=100, show_default=True)
+def compress_texts_command(batch_size):
+    target_subtype = mongo.compression_subtypes.get(mongo.get_text_compressor())
+    for collection_name, fields in mongo.compressed_fields.items():
+        converted_count = 0
+        for field in fields:
+            queries = [{field: {'$type': 'binData'}}]
+            if target_subtype:
+                text_length = {'$strLenCP': {'$cond': [{'$eq': [{'$type': f'${field}'}, 'string']}, f'${field}', '']}}
+                queries.append({'$expr': {'$gte': [text_length, mongo.get_compression_threshold()]}})
+            for documents in mongo.find_batches(collection_name, {'$or': queries}, batch_size, {field: True}):
+                operations = []
+                for document in documents:
+                    stored_value = document[field]
+                    if isinstance(stored_value, Binary) and stored_value.subtype == target_subtype:
+                        continue
+                    text = mongo.decompress_text(stored_value)
+                    encoded_value = mongo.compress_texts(collection_name, {field: text})[field]
+                    if encoded_value != stored_value:
+                        operations.append(UpdateOne({'_id': document['_id']}, {'$set': {field: encoded_value}}))
+                mongo.bulk_write(collection_name, operations, ordered=False)
+                converted_count += len(operations)
+        report_migration(collection_name, converted_count, [])
+
+
+@migrate_cli.command('updated-dates')
+@click.option('--batch-size', default=500, show_default=True)
+def migrate_updated_dates_command(batch_size):
+    for collection_name in mongo.updated_date_collections:
+        converted_count = 0
+        query = {'updated_date': {'$exists': False}}
+        projection = {'creation_date': True, 'last_message.creation_date': True}
+        for documents in mongo.find_batches(collection_name, query, batch_size, projection):
+            operations = []
+            for document in documents:
+                creation_date = document.get('creation_date') or document.get('last_message', {}).get('creation_date')
+                if isinstance(creation_date, str):
+                    creation_date = mongo.parse_date(creation_date)
+                updated_date = creation_date or document['_id'].generation_time.replace(tzinfo=None)
+                operations.append(UpdateOne({'_id': document['_id']}, {'$set': {'updated_date': updated_date}}))
+            mongo.bulk_write(collection_name, operations, ordered=False)
+            converted_count += len(operations)
+        report_migration(collection_name, converted_count, [])
+
+
+def report_migration(collection_name, converted_count, skipped_ids):
+    click.echo(f'{collection_name}: {converted_count} converted')
+    if skipped_ids:
+        click.echo(f'{collection_name}: {len(skipped_ids)} skipped, unknown date format: {", ".join(skipped_ids)}')
@@ -1,43 +1,530 @@
-from bson import ObjectId
+import bson
+from bson import Binary, json_util, ObjectId
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from pymongo import monitoring, ReadPreference
+from threading import Lock
+import base64
+import logging
+import math
+import os
 import pymongo
+import zlib
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-connection_entries = {
-    'host': '127.0.0.1',
-    'port': 27017
+
+# MONGO_URI, MONGO_DATABASE and the client options below are read when a process creates its first client
+integer_client_options = {
+    'maxPoolSize': 'MONGO_MAX_POOL_SIZE',
+    'connectTimeoutMS': 'MONGO_CONNECT_TIMEOUT_MS',
+    'socketTimeoutMS': 'MONGO_SOCKET_TIMEOUT_MS',
+    'serverSelectionTimeoutMS': 'MONGO_SERVER_SELECTION_TIMEOUT_MS',
+}
+read_preferences = {
+    'primary': ReadPreference.PRIMARY,
+    'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+    'secondary': ReadPreference.SECONDARY,
+    'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+    'nearest': ReadPreference.NEAREST,
+}
+reads_are_routed = ContextVar('reads_are_routed', default=False)
+client, client_pid, database, routed_read_preference = None, None, None, ReadPreference.PRIMARY
+client_lock = Lock()
+# Commands issued while command_log holds a CommandLog are recorded into it, see CommandRecorder
+command_log = ContextVar('command_log', default=None)
+
+date_fields = ['creation_date', 'status_changed_date']
+legacy_date_formats = ['%d.%m.%y %H:%M:%S', '%d.%m.%y %H:%M', '%d.%m.%Y']
+
+compressed_fields = {'contract': ['text'], 'version': ['text']}
+# Every insert and update through this module stamps updated_date on these collections, the export endpoints sync by it
+updated_date_collections = ['contract', 'dialog', 'invitation', 'notification']
+compression_subtypes = {'zlib': 128, 'zstd': 129}
+
+logger = logging.getLogger(__name__)
+ASC, DESC, TEXT = pymongo.ASCENDING, pymongo.DESCENDING, pymongo.TEXT
+indexes = {
+    'comment': [[('contract_id', ASC), ('number', ASC)]],
+    'contract': [
+        [('companies.id', ASC), ('creation_date', DESC), ('_id', DESC)],
+        [('companies.id', ASC), ('updated_date', ASC), ('_id', ASC)],
+        [('deletion.stage', ASC)],
+    ],
+    'dialog': [
+        [('participants.id', ASC), ('last_message.creation_date', DESC), ('_id', DESC)],
+        [('participants.id', ASC), ('contract_id', ASC), ('last_message.creation_date', DESC), ('_id', DESC)],
+        [('participants.id', ASC), ('updated_date', ASC), ('_id', ASC)],
+        [('contract_id', ASC)],
+    ],
+    'employee': [[('company_id', ASC), ('role_id', ASC)], [('name', ASC)]],
+    'invitation': [
+        [('recipient.id', ASC), ('status', ASC)],
+        [('recipient.id', ASC), ('creation_date', DESC), ('_id', DESC)],
+        [('creator.id', ASC), ('creation_date', DESC), ('_id', DESC)],
+        [('recipient.id', ASC), ('updated_date', ASC), ('_id', ASC)],
+        [('creator.id', ASC), ('updated_date', ASC), ('_id', ASC)],
+        [('contract_id', ASC), ('type', ASC)],
+    ],
+    'message': [[('dialog_id', ASC), ('_id', DESC)], [('unread_by', ASC)]],
+    'notification': [
+        [('recipient_id', ASC), ('is_read', ASC)],
+        [('recipient_id', ASC), ('creation_date', DESC), ('_id', DESC)],
+        [('recipient_id', ASC), ('updated_date', ASC), ('_id', ASC)],
+        [('contract_id', ASC)],
+    ],
+    'role': [[('name', ASC)]],
+    'search_entry': [[('scope_id', ASC), ('text', TEXT)], [('entry_id', ASC)], [('contract_id', ASC), ('kind', ASC)]],
+    'version': [
+        [('contract_id', ASC), ('creator_id', ASC), ('creation_date', ASC)],
+        [('contract_id', ASC), ('_id', DESC)],
+        [('base_id', ASC)],
+    ],
 }
-client = pymongo.MongoClient(**connection_entries)
-database = client['contracts-management']
+# Query shapes issued by app.py, explained by `flask explain-queries`. Values are placeholders: only the shape matters.
+query_shapes = [
+    ('comment', {'contract_id': 'id'}, None),
+    ('comment', {'contract_id': 'id', 'number': 0}, None),
+    ('contract', {'companies': {'$elemMatch': {'id': 'id'}}, 'deletion': {'$exists': False}},
+     [('creation_date', DESC), ('_id', DESC)]),
+    ('contract', {'companies': {'$elemMatch': {'id': 'id'}}, 'deletion': {'$exists': False},
+                  'updated_date': {'$gte': datetime.now()}}, [('updated_date', ASC), ('_id', ASC)]),
+    ('contract', {'deletion.stage': {'$in': ['statistics']}}, None),
+    ('contract', {'deletion.stage': {'$in': ['statistics']}, 'deletion.updated_date': {'$lt': datetime.now()}}, None),
+    ('dialog', {'participants': {'$elemMatch': {'id': 'id'}}},
+     [('last_message.creation_date', DESC), ('_id', DESC)]),
+    ('dialog', {'contract_id': 'id', 'participants': {'$elemMatch': {'id': 'id'}}},
+     [('last_message.creation_date', DESC), ('_id', DESC)]),
+    ('dialog', {'participants': {'$elemMatch': {'id': 'id'}}, 'updated_date': {'$gte': datetime.now()}},
+     [('updated_date', ASC), ('_id', ASC)]),
+    ('dialog', {'contract_id': 'id'}, None),
+    ('employee', {'company_id': 'id'}, None),
+    ('employee', {'company_id': 'id', 'role_id': 'id'}, None),
+    ('employee', {'name': 'name'}, None),
+    ('employee', {'company_id': {'$in': ['id']}}, None),
+    ('employee', {'_id': {'$in': [ObjectId()]}}, None),
+    ('invitation', {'recipient.id': 'id', 'status': 'pending'}, None),
+    ('invitation', {'$or': [{'creator.id': 'id'}, {'recipient.id': 'id'}]}, [('creation_date', DESC), ('_id', DESC)]),
+    ('invitation', {'$or': [{'creator.id': 'id', 'contract_id': 'id'}, {'recipient.id': 'id', 'contract_id': 'id'}]},
+     [('creation_date', DESC), ('_id', DESC)]),
+    ('invitation', {'$or': [{'creator.id': 'id'}, {'recipient.id': 'id'}], 'updated_date': {'$gte': datetime.now()}},
+     [('updated_date', ASC), ('_id', ASC)]),
+    ('invitation', {'$or': [{'contract_id': 'id', 'type': 'editing'}]}, None),
+    ('invitation', {'contract_id': 'id', 'type': 'editing'}, None),
+    ('message', {'dialog_id': 'id'}, [('_id', DESC)]),
+    ('message', {'dialog_id': 'id', '_id': {'$lt': ObjectId()}}, [('_id', DESC)]),
+    ('message', {'dialog_id': {'$in': ['id']}}, None),
+    ('message', {'unread_by': 'id'}, None),
+    ('message', {'_id': {'$in': [ObjectId()]}, 'unread_by': 'id'}, None),
+    ('notification', {'recipient_id': 'id', 'is_read': False}, None),
+    ('notification', {'recipient_id': 'id'}, [('creation_date', DESC), ('_id', DESC)]),
+    ('notification', {'recipient_id': 'id', 'contract_id': 'id'}, [('creation_date', DESC), ('_id', DESC)]),
+    ('notification', {'recipient_id': 'id', 'updated_date': {'$gte': datetime.now()}},
+     [('updated_date', ASC), ('_id', ASC)]),
+    ('notification', {'contract_id': 'id'}, None),
+    ('role', {'name': 'director'}, None),
+    ('search_entry', {'scope_id': 'id', '$text': {'$search': 'text'}},
+     [('score', {'$meta': 'textScore'}), ('_id', ASC)]),
+    ('search_entry', {'$and': [{'scope_id': 'id', '$text': {'$search': 'text'}}, {'contract_id': {'$nin': ['id']}}]},
+     [('score', {'$meta': 'textScore'}), ('_id', ASC)]),
+    ('search_entry', {'contract_id': 'id'}, None),
+    ('search_entry', {'kind': 'comment', 'contract_id': 'id', 'item_id': '0'}, None),
+    ('role', {'name': {'$in': ['director']}}, None),
+    ('version', {'contract_id': 'id', 'creator_id': 'id'}, None),
+    ('version', {'contract_id': 'id'}, None),
+    ('version', {'contract_id': 'id'}, [('_id', DESC)]),
+    ('version', {'base_id': 'id'}, None),
+]
+explained_query_shapes = set()
+
+
+def ensure_indexes():
+    for collection_name, collection_indexes in indexes.items():
+        index_models = [pymongo.IndexModel(keys) for keys in collection_indexes]
+        get_collection(collection_name).create_indexes(index_models)
+
+
+def find_collection_scans(shapes: list):
+    collection_scans = []
+    for collection_name, query, sort in shapes:
+        cursor = get_collection(collection_name).find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        winning_plan = cursor.explain()['queryPlanner']['winningPlan']
+        if 'COLLSCAN' in get_plan_stages(winning_plan):
+            collection_scans.append((collection_name, query, sort))
+    return collection_scans
+
+
+def get_plan_stages(plan):
+    stages = [plan.get('stage')]
+    if 'inputStage' in plan:
+        stages.extend(get_plan_stages(plan['inputStage']))
+    for input_stage in plan.get('inputStages', []):
+        stages.extend(get_plan_stages(input_stage))
+    return stages
+
+
+def get_query_shape(query):
+    if isinstance(query, dict):
+        return {key: get_query_shape(value) for key, value in query.items()}
+    if isinstance(query, list):
+        return [get_query_shape(item) for item in query[:1]]
+    return 1
+
+
+def register_query(collection_name, query, sort=None):
+    if not is_explaining_queries():
+        return
+    query_shape = (collection_name, json_util.dumps(get_query_shape(query), sort_keys=True), str(sort))
+    if query_shape in explained_query_shapes:
+        return
+    explained_query_shapes.add(query_shape)
+    if find_collection_scans([(collection_name, query, sort)]):
+        logger.warning('COLLSCAN on %s for query shape %s, sort %s', collection_name, query_shape[1], sort)
+
+
+# Settings are read on use rather than on import, so values loaded from .env by app.py apply
+def is_explaining_queries():
+    return os.environ.get('MONGO_EXPLAIN_QUERIES') == '1'
+
+
+def get_text_compressor():
+    # MONGO_TEXT_COMPRESSOR is zlib, zstd (requires the zstandard package) or none
+    return os.environ.get('MONGO_TEXT_COMPRESSOR', 'zlib')
+
+
+def get_compression_threshold():
+    return int(os.environ.get('MONGO_TEXT_COMPRESSION_THRESHOLD', 16 * 1024))
 
 
-def find_documents(collection_name, query):
-    return database[collection_name].find(query)
+def get_database():
+    global client, client_pid, database, routed_read_preference
+    with client_lock:
+        if client is None or client_pid != os.getpid():
+            client_options = {option: int(os.environ[variable]) for option, variable in integer_client_options.items()
+                              if os.environ.get(variable)}
+            # MONGO_COMPRESSORS is a comma separated list of wire compressors, e.g. zstd,zlib
+            if os.environ.get('MONGO_COMPRESSORS'):
+                client_options['compressors'] = os.environ['MONGO_COMPRESSORS']
+            client = pymongo.MongoClient(os.environ.get('MONGO_URI', 'mongodb://127.0.0.1:27017'),
+                                         event_listeners=[CommandRecorder()], **client_options)
+            client_pid = os.getpid()
+            database = client[os.environ.get('MONGO_DATABASE', 'contracts-management')]
+            # MONGO_ROUTED_READ_PREFERENCE applies to reads inside routed_reads(), e.g. secondaryPreferred
+            routed_read_preference = read_preferences[os.environ.get('MONGO_ROUTED_READ_PREFERENCE', 'primary')]
+        return database
 
 
-def find_documents_under_operator(collection_name, operator, queries: list):
-    return database[collection_name].find({f'${operator}': queries})
+def get_collection(collection_name):
+    collection = get_database()[collection_name]
+    if reads_are_routed.get() and routed_read_preference != ReadPreference.PRIMARY:
+        return collection.with_options(read_preference=routed_read_preference)
+    return collection
 
 
-def find_one_document(collection_name, query):
-    return database[collection_name].find_one(query)
+@contextmanager
+def routed_reads():
+    token = reads_are_routed.set(True)
+    try:
+        yield
+    finally:
+        reads_are_routed.reset(token)
+
+
+def find_documents(collection_name, query, sort=None, limit=0, projection=None, batch_size=0):
+    register_query(collection_name, query, sort)
+    documents = get_collection(collection_name).find(query, projection, sort=sort, limit=limit, batch_size=batch_size)
+    if collection_name in compressed_fields:
+        return (decompress_texts(collection_name, document) for document in documents)
+    return documents
+
+
+def find_page(collection_name, query, sort_field, descending, current_page, per_page, after=None, projection=None):
+    direction = pymongo.DESCENDING if descending else pymongo.ASCENDING
+    sort = [('_id', direction)] if sort_field == '_id' else [(sort_field, direction), ('_id', direction)]
+    register_query(collection_name, query, sort)
+    collection = get_collection(collection_name)
+    records_count = collection.count_documents(query)
+    min_pages_count = 1
+    pages_count = math.ceil(records_count / per_page) or min_pages_count
+    if after:
+        previous_page, last_value, last_id = decode_cursor(after, sort_field, descending)
+        current_page = previous_page + 1
+        query = {'$and': [query, build_keyset_condition(sort_field, descending, last_value, last_id)]}
+        records = list(collection.find(query, projection).sort(sort).limit(per_page))
+    else:
+        if current_page > pages_count:
+            init_page = 1
+            current_page = init_page
+        records = list(collection.find(query, projection).sort(sort).skip((current_page - 1) * per_page)
+                       .limit(per_page))
+    next_cursor = None
+    if records and current_page < pages_count:
+        last_record = records[-1]
+        next_cursor = encode_cursor(current_page, sort_field, descending, get_field_value(last_record, sort_field),
+                                    last_record['_id'])
+    return {'currentPage': current_page, 'pagesCount': pages_count, 'records': records, 'nextCursor': next_cursor}
+
+
+def build_keyset_condition(sort_field, descending, last_value, last_id):
+    operator = '$lt' if descending else '$gt'
+    if sort_field == '_id':
+        return {'_id': {operator: last_id}}
+    return {'$or': [{sort_field: {operator: last_value}}, {sort_field: last_value, '_id': {operator: last_id}}]}
+
+
+def encode_cursor(page, sort_field, descending, last_value, last_id):
+    serialized_cursor = json_util.dumps([page, sort_field, descending, last_value, last_id])
+    return base64.urlsafe_b64encode(serialized_cursor.encode()).decode()
+
+
+def decode_cursor(cursor, sort_field, descending):
+    try:
+        page, cursor_sort_field, cursor_descending, last_value, last_id = \
+            json_util.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (TypeError, ValueError):
+        raise InvalidCursor('Malformed cursor')
+    if not isinstance(page, int) or isinstance(page, bool) or page < 1 or not isinstance(last_id, ObjectId):
+        raise InvalidCursor('Malformed cursor')
+    if (cursor_sort_field, cursor_descending) != (sort_field, descending):
+        raise InvalidCursor('Cursor was issued for another sorting')
+    return page, last_value, last_id
+
+
+def get_field_value(document, field_path):
+    value = document
+    for key in field_path.split('.'):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def find_by_ids(collection_name, documents_id: list, projection=None):
+    query = {'_id': {'$in': [ObjectId(document_id) for document_id in documents_id]}}
+    register_query(collection_name, query)
+    documents = get_collection(collection_name).find(query, projection)
+    return {str(document['_id']): decompress_texts(collection_name, document) for document in documents}
+
+
+def count_documents(collection_name, query):
+    register_query(collection_name, query)
+    return get_collection(collection_name).count_documents(query)
+
+
+def find_documents_under_operator(collection_name, operator, queries: list, projection=None):
+    register_query(collection_name, {f'${operator}': queries})
+    return get_collection(collection_name).find({f'${operator}': queries}, projection)
+
+
+def find_one_document(collection_name, query, projection=None):
+    register_query(collection_name, query)
+    return decompress_texts(collection_name, get_collection(collection_name).find_one(query, projection))
 
 
 def insert_one_document(collection_name, document):
-    result = database[collection_name].insert_one(document)
+    result = get_collection(collection_name).insert_one(encode_new_document(collection_name, document))
     return str(result.inserted_id)
 
 
 def insert_documents(collection_name, documents: list):
-    database[collection_name].insert_many(documents)
+    get_collection(collection_name).insert_many([encode_new_document(collection_name, document)
+                                                 for document in documents])
 
 
 def update_one_document(collection_name, document_id, new_document):
-    database[collection_name].update_one({'_id': ObjectId(document_id)}, {'$set': new_document})
+    get_collection(collection_name).update_one({'_id': ObjectId(document_id)},
+                                               encode_update(collection_name, {'$set': new_document}))
+
+
+def aggregate(collection_name, pipeline: list):
+    return get_collection(collection_name).aggregate(pipeline)
+
+
+def bulk_write(collection_name, operations: list, ordered=True):
+    if operations:
+        get_collection(collection_name).bulk_write(operations, ordered=ordered)
+
+
+def find_batches(collection_name, query, batch_size, projection=None):
+    last_id = None
+    while True:
+        batch_query = {'$and': [query, {'_id': {'$gt': last_id}}]} if last_id else query
+        batch = list(get_collection(collection_name).find(batch_query, projection).sort('_id', pymongo.ASCENDING)
+                     .limit(batch_size))
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1]['_id']
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class CommandLog:
+    def __init__(self):
+        self.pending, self.commands = {}, []
+
+    def get_totals(self):
+        return {'commands': len(self.commands), 'bytes': sum(command['bytes'] for command in self.commands),
+                'seconds': sum(command['seconds'] for command in self.commands)}
+
+
+class CommandRecorder(monitoring.CommandListener):
+    def started(self, event):
+        log = command_log.get()
+        if log is not None:
+            collection_field = 'collection' if event.command_name == 'getMore' else event.command_name
+            log.pending[event.request_id] = {'name': event.command_name,
+                                             'collection': str(event.command.get(collection_field, '')),
+                                             'bytes': len(bson.encode(event.command))}
+
+    def succeeded(self, event):
+        self.finish(event, len(bson.encode(event.reply)))
+
+    def failed(self, event):
+        self.finish(event, 0)
+
+    def finish(self, event, reply_bytes):
+        log = command_log.get()
+        command = log.pending.pop(event.request_id, None) if log is not None else None
+        if command:
+            command['bytes'] += reply_bytes
+            command['seconds'] = event.duration_micros / 1e6
+            log.commands.append(command)
+
+
+def find_one_and_update(collection_name, query, update, projection=None, return_updated=False):
+    update = encode_update(collection_name, update)
+    return_document = pymongo.ReturnDocument.AFTER if return_updated else pymongo.ReturnDocument.BEFORE
+    document = get_collection(collection_name).find_one_and_update(query, update, projection,
+                                                             return_document=return_document)
+    return decompress_texts(collection_name, document)
+
+
+def update_with_revision(collection_name, document_id, revision, update):
+    query = {'_id': ObjectId(document_id), 'revision': revision}
+    update = {**update, '$inc': {**update.get('$inc', {}), 'revision': 1}}
+    return bool(update_one_by_query(collection_name, query, update))
+
+
+def update_one_by_query(collection_name, query, update):
+    update = encode_update(collection_name, update)
+    return get_collection(collection_name).update_one(query, update).modified_count
+
+
+def update_many_documents(collection_name, query, update):
+    update = encode_update(collection_name, update)
+    return get_collection(collection_name).update_many(query, update).modified_count
 
 
 def delete_one_document(collection_name, query):
-    database[collection_name].delete_one(query)
+    get_collection(collection_name).delete_one(query)
 
 
 def delete_many_documents(collection_name, query):
-    database[collection_name].delete_many(query)
+    get_collection(collection_name).delete_many(query)
+
+
+def compress_text(text):
+    encoded_text = text.encode()
+    if get_text_compressor() == 'zstd' and zstandard:
+        return Binary(zstandard.ZstdCompressor().compress(encoded_text), compression_subtypes['zstd'])
+    return Binary(zlib.compress(encoded_text), compression_subtypes['zlib'])
+
+
+def compress_texts(collection_name, document):
+    if get_text_compressor() == 'none':
+        return document
+    compression_threshold = get_compression_threshold()
+    for field in compressed_fields.get(collection_name, []):
+        value = document.get(field)
+        if isinstance(value, str) and len(value) >= compression_threshold:
+            document = {**document, field: compress_text(value)}
+    return document
+
+
+def decompress_text(value):
+    if not isinstance(value, Binary):
+        return value
+    if value.subtype == compression_subtypes['zlib']:
+        return zlib.decompress(value).decode()
+    if value.subtype == compression_subtypes['zstd']:
+        return zstandard.ZstdDecompressor().decompress(value).decode()
+    return value
+
+
+def decompress_texts(collection_name, document):
+    if document:
+        for field in compressed_fields.get(collection_name, []):
+            if field in document:
+                document[field] = decompress_text(document[field])
+    return document
+
+
+def get_text_sizes(collection_name, field, batch_size=100):
+    sizes = {'documents': 0, 'compressed_documents': 0, 'text_bytes': 0, 'stored_bytes': 0}
+    for documents in find_batches(collection_name, {field: {'$exists': True}}, batch_size, {field: True}):
+        for document in documents:
+            stored_value = document[field]
+            text_bytes = len(decompress_text(stored_value).encode())
+            sizes['documents'] += 1
+            sizes['compressed_documents'] += isinstance(stored_value, Binary)
+            sizes['text_bytes'] += text_bytes
+            sizes['stored_bytes'] += len(stored_value) if isinstance(stored_value, Binary) else text_bytes
+    return sizes
+
+
+def encode_document(collection_name, document):
+    return compress_texts(collection_name, encode_dates(document))
+
+
+def encode_new_document(collection_name, document):
+    if collection_name in updated_date_collections:
+        document.setdefault('updated_date', datetime.now())
+    return encode_document(collection_name, document)
+
+
+def encode_update(collection_name, update):
+    update_set = update.get('$set', {})
+    if collection_name in updated_date_collections:
+        update_set = {**update_set, 'updated_date': datetime.now()}
+    if update_set:
+        update = {**update, '$set': encode_document(collection_name, update_set)}
+    return update
+
+
+def encode_dates(document):
+    for field, value in document.items():
+        if field in date_fields and isinstance(value, str):
+            document[field] = parse_date(value) or value
+        elif isinstance(value, dict):
+            encode_dates(value)
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, dict):
+                    encode_dates(item)
+    return document
+
+
+def get_date_sort_key(value):
+    # Legacy string dates sort with datetimes until `flask migrate dates` has converted them
+    if isinstance(value, datetime):
+        return value
+    return (parse_date(value) if isinstance(value, str) else None) or datetime.min
+
+
+def parse_date(value):
+    for date_format in legacy_date_formats:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
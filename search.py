@@ -0,0 +1,129 @@
+import deletion
+import html
+import math
+import mongo
+import re
+from bson import ObjectId
+from pymongo import DeleteMany, ReplaceOne
+
+
+# Every searchable item has one search_entry per scope that may see it: the contract companies for contract texts
+# and comment threads, the dialog participants for messages. Searches then match on the scope_id prefix of the text
+# index and only touch the entries of one company and one employee, whatever the number of dialogs. An everybody
+# dialog writes one entry per participant in a single bulk write in exchange.
+markup_pattern = re.compile(r'<[^>]*>')
+whitespace_pattern = re.compile(r'\s+')
+snippet_length = 160
+
+
+def index_contract(contract_id, text, companies=None):
+    if companies is None:
+        contract = mongo.find_one_document('contract', {'_id': ObjectId(contract_id), **deletion.live_contract_query},
+                                           {'companies': True})
+        if not contract:
+            return
+        companies = contract['companies']
+    entry = {'kind': 'contract', 'item_id': contract_id, 'contract_id': contract_id, 'text': strip_markup(text)}
+    save_entries(entry, [company['id'] for company in companies])
+
+
+def index_comment(contract_id, number):
+    comment = mongo.find_one_document('comment', {'contract_id': contract_id, 'number': number},
+                                      {'related_comments.text': True})
+    if not comment:
+        remove_comments(contract_id, number)
+        return
+    contract = mongo.find_one_document('contract', {'_id': ObjectId(contract_id), **deletion.live_contract_query},
+                                       {'companies': True})
+    if not contract:
+        return
+    text = ' '.join(related_comment['text'] for related_comment in comment['related_comments'])
+    entry = {'kind': 'comment', 'item_id': str(number), 'contract_id': contract_id, 'text': strip_markup(text)}
+    save_entries(entry, [company['id'] for company in contract['companies']])
+
+
+def index_message(message, dialog):
+    entry = {'kind': 'message', 'item_id': str(message['_id']), 'contract_id': dialog['contract_id'],
+             'dialog_id': str(dialog['_id']), 'text': message['text'], 'creation_date': message['creation_date']}
+    save_entries(entry, [participant['id'] for participant in dialog['participants']])
+
+
+def remove_comments(contract_id, number=None):
+    query = {'kind': 'comment', 'contract_id': contract_id}
+    if number is not None:
+        query['item_id'] = str(number)
+    mongo.delete_many_documents('search_entry', query)
+
+
+def save_entries(entry, scopes_id: list):
+    entry_id = f"{entry['kind']}:{entry['contract_id']}:{entry['item_id']}"
+    operations = [DeleteMany({'entry_id': entry_id, 'scope_id': {'$nin': scopes_id}})]
+    for scope_id in scopes_id:
+        scoped_entry = {**entry, '_id': f'{entry_id}:{scope_id}', 'entry_id': entry_id, 'scope_id': scope_id}
+        operations.append(ReplaceOne({'_id': scoped_entry['_id']}, scoped_entry, upsert=True))
+    mongo.bulk_write('search_entry', operations, ordered=False)
+
+
+def search(company_id, employee_id, query_text, current_page, per_page):
+    hits_limit = current_page * per_page
+    projection = {'text': False, 'score': {'$meta': 'textScore'}}
+    sort = [('score', {'$meta': 'textScore'}), ('_id', mongo.ASC)]
+    hits, hits_count = {}, 0
+    deleted_contracts_id = deletion.find_deleted_contracts_id()
+    for scope_id in dict.fromkeys([company_id, employee_id]):
+        query = deletion.exclude_deleted_contracts({'scope_id': scope_id, '$text': {'$search': query_text}},
+                                                   deleted_contracts_id)
+        for hit in mongo.find_documents('search_entry', query, sort, hits_limit, projection):
+            hits[hit['entry_id']] = hit
+        hits_count += mongo.count_documents('search_entry', query)
+    ranked_hits = sorted(hits.values(), key=lambda hit: (-hit['score'], hit['_id']))
+    page_hits = ranked_hits[(current_page - 1) * per_page:hits_limit]
+    texts = {entry['_id']: entry['text'] for entry in mongo.find_documents(
+        'search_entry', {'_id': {'$in': [hit['_id'] for hit in page_hits]}}, projection={'text': True})}
+    terms = [term.strip('"').lower() for term in query_text.split() if not term.startswith('-')]
+    records = []
+    for hit in page_hits:
+        record = {'kind': hit['kind'], 'contract_id': hit['contract_id'], 'item_id': hit['item_id'],
+                  'score': round(hit['score'], 3), 'snippet': create_snippet(texts.get(hit['_id'], ''), terms)}
+        if hit['kind'] == 'message':
+            record.update({'dialog_id': hit['dialog_id'], 'creation_date': hit['creation_date']})
+        records.append(record)
+    return {'currentPage': current_page, 'pagesCount': max(math.ceil(hits_count / per_page), 1), 'records': records}
+
+
+def create_snippet(text, terms: list):
+    if len(text) <= snippet_length:
+        return text
+    lowered_text = text.lower()
+    positions = [position for position in (lowered_text.find(term) for term in terms if term) if position >= 0]
+    start = max(min(positions, default=0) - snippet_length // 4, 0)
+    snippet = text[start:start + snippet_length]
+    return ('…' if start else '') + snippet + ('…' if start + snippet_length < len(text) else '')
+
+
+def strip_markup(text):
+    return whitespace_pattern.sub(' ', html.unescape(markup_pattern.sub(' ', text))).strip()
+
+
+def rebuild_search_index(batch_size):
+    mongo.delete_many_documents('search_entry', {})
+    items_count = 0
+    contract_projection = {'text': True, 'companies': True}
+    for contracts in mongo.find_batches('contract', deletion.live_contract_query, batch_size, contract_projection):
+        for contract in contracts:
+            contract_text = mongo.decompress_text(contract['text'])
+            index_contract(str(contract['_id']), contract_text, contract['companies'])
+        items_count += len(contracts)
+    for comments in mongo.find_batches('comment', {}, batch_size, {'contract_id': True, 'number': True}):
+        for comment in comments:
+            index_comment(comment['contract_id'], comment['number'])
+        items_count += len(comments)
+    dialog_projection = {'contract_id': True, 'participants.id': True}
+    for dialogs in mongo.find_batches('dialog', {}, batch_size, dialog_projection):
+        for dialog in dialogs:
+            message_projection = {'text': True, 'creation_date': True}
+            for message in mongo.find_documents('message', {'dialog_id': str(dialog['_id'])},
+                                                projection=message_projection):
+                index_message(message, dialog)
+                items_count += 1
+    return items_count
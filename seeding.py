@@ -0,0 +1,212 @@
+import counters
+import dashboard
+import mongo
+import random
+import utils
+import versions
+from bson import ObjectId
+from datetime import datetime, timedelta
+
+
+seeded_collections = ['company', 'employee', 'contract', 'comment', 'version', 'invitation', 'notification', 'dialog',
+                      'message']
+role_names = ['lawyer', 'economist', 'director']
+zesla_group_id = '60338c13136d90fcdc76de24'
+first_names = ['Yura', 'Sonya', 'Gustavo', 'Danya', 'Vasya', 'Olga', 'Ivan', 'Marta', 'Pavel', 'Irina', 'Anton',
+               'Nina', 'Oleg', 'Vera', 'Boris', 'Lena']
+last_names = ['Kotov', 'Nagiev', 'Petrova', 'Smirnov', 'Ivanova', 'Popov', 'Sokolova', 'Lebedev', 'Kozlova',
+              'Novikov', 'Morozova', 'Volkov']
+company_words = ['Green', 'Zila', 'ABC', 'Nord', 'Vector', 'Orbit', 'Granit', 'Delta', 'Atlas', 'Sever', 'Luch',
+                 'Kvant']
+text_words = ['agreement', 'party', 'parties', 'supplier', 'customer', 'equipment', 'delivery', 'payment',
+              'obligation', 'term', 'shall', 'within', 'days', 'measurement', 'construction', 'site', 'warranty',
+              'liability', 'invoice', 'the', 'of', 'and', 'to', 'in', 'under', 'this', 'contract', 'price',
+              'acceptance', 'certificate', 'notice', 'written', 'force', 'majeure', 'dispute', 'law']
+message_words = ['please', 'check', 'the', 'clause', 'about', 'payment', 'terms', 'ok', 'agreed', 'we', 'need',
+                 'changes', 'in', 'delivery', 'dates', 'thanks', 'see', 'my', 'comment', 'tomorrow']
+
+
+def seed(contracts_count, companies_count, text_length, max_messages, batch_size, seed_value, report):
+    rng = random.Random(seed_value)
+    mongo.ensure_indexes()
+    roles = ensure_roles()
+    companies = create_companies(rng, companies_count)
+    employees = create_employees(rng, companies, roles)
+    mongo.insert_documents('company', companies)
+    mongo.insert_documents('employee', employees)
+    employees_by_company = {}
+    for employee in employees:
+        employees_by_company.setdefault(employee['company_id'], []).append(employee)
+    directors = {employee['company_id']: employee for employee in employees if employee['role_id'] == roles['director']}
+    now = datetime.now()
+    for batch_start in range(0, contracts_count, batch_size):
+        documents = {collection_name: [] for collection_name in seeded_collections}
+        for _ in range(batch_start, min(batch_start + batch_size, contracts_count)):
+            add_contract(rng, documents, companies, employees_by_company, directors, text_length, max_messages, now)
+        for collection_name, collection_documents in documents.items():
+            if collection_documents:
+                mongo.insert_documents(collection_name, collection_documents)
+        report(min(batch_start + batch_size, contracts_count), contracts_count)
+    counters.rebuild_counters()
+    dashboard.rebuild_dashboards()
+    return {'companies': len(companies), 'employees': len(employees), 'contracts': contracts_count}
+
+
+def drop_seeded_collections():
+    for collection_name in seeded_collections + ['counter', 'company_stat']:
+        mongo.get_collection(collection_name).drop()
+
+
+def ensure_roles():
+    roles = {role['name']: str(role['_id']) for role in mongo.find_documents('role', {})}
+    missing_roles = [{'_id': ObjectId(), 'name': role_name} for role_name in role_names if role_name not in roles]
+    if missing_roles:
+        mongo.insert_documents('role', missing_roles)
+        roles.update({role['name']: str(role['_id']) for role in missing_roles})
+    return roles
+
+
+def create_companies(rng, companies_count):
+    companies = []
+    for number in range(companies_count):
+        company_id = ObjectId(zesla_group_id) if number == 0 else ObjectId()
+        name = 'Zesla Group' if number == 0 else f'{rng.choice(company_words)} {number}'
+        if not mongo.find_one_document('company', {'_id': company_id}, {'_id': True}):
+            companies.append({'_id': company_id, 'name': name})
+    return companies
+
+
+def create_employees(rng, companies, roles):
+    employees = []
+    for company in companies:
+        company_roles = ['director'] + ['lawyer'] * rng.randint(1, 3) + ['economist'] * rng.randint(1, 3)
+        for role_name in company_roles:
+            employee_id = ObjectId()
+            name = f'{rng.choice(first_names)} {rng.choice(last_names)} {employee_id}'
+            employees.append({'_id': employee_id, 'name': name, 'company_id': str(company['_id']),
+                              'role_id': roles[role_name], 'email': f'{employee_id}@example.com'})
+    return employees
+
+
+def add_contract(rng, documents, companies, employees_by_company, directors, text_length, max_messages, now):
+    contract_companies = [companies[0]] if rng.random() < 0.3 else []
+    contract_companies += rng.sample(companies[1:], rng.choice([2, 2, 3]) - len(contract_companies))
+    companies_entities = [{'id': str(company['_id']), 'name': company['name']} for company in contract_companies]
+    employees = [employee for company in companies_entities for employee in employees_by_company[company['id']]]
+    contract_id = str(ObjectId())
+    creation_date = now - timedelta(seconds=rng.randint(3600, 2 * 365 * 24 * 3600))
+    comments_count = rng.choice([0, 0, 1, 2, 3])
+    text = create_text(rng, rng.randint(text_length // 2, text_length * 3 // 2), comments_count)
+    status = utils.create_initial_status(companies_entities)
+    status['name'] = rng.choice(dashboard.contract_statuses)
+    documents['contract'].append({
+        '_id': ObjectId(contract_id), 'text': text, 'companies': companies_entities, 'creation_date': creation_date,
+        'status': status, 'status_changed_date': create_date_after(rng, creation_date, now), 'revision': 0,
+        'comments_revision': 0, 'versions_revision': 0, 'comment_anchors': utils.find_comment_anchors(text)
+    })
+    for number in range(comments_count):
+        related_comments = [{'id': id, 'author': rng.choice(employees)['name'], 'text': create_sentence(rng),
+                             'creation_date': create_date_after(rng, creation_date, now)}
+                            for id in range(rng.randint(1, 4))]
+        documents['comment'].append({'contract_id': contract_id, 'number': number,
+                                     'related_comments': related_comments})
+    add_versions(rng, documents, contract_id, text, employees, creation_date, now)
+    add_invitations(rng, documents, contract_id, companies_entities, employees_by_company, directors, creation_date,
+                    now)
+    for _ in range(rng.randint(0, 3)):
+        type = rng.choice(list(utils.notification_texts))
+        documents['notification'].append({
+            'contract_id': contract_id, 'recipient_id': str(rng.choice(employees)['_id']), 'type': type,
+            'text': utils.notification_texts[type], 'is_read': rng.random() < 0.7,
+            'creation_date': create_date_after(rng, creation_date, now)
+        })
+    if rng.random() < 0.3:
+        add_dialog(rng, documents, contract_id, employees, max_messages, creation_date, now)
+
+
+def add_versions(rng, documents, contract_id, text, employees, creation_date, now):
+    base_version, base_text = None, None
+    for _ in range(rng.choice([0, 0, 1, 2, 3])):
+        version_text = edit_text(rng, text)
+        version = {'_id': ObjectId(), 'contract_id': contract_id, 'creator_id': str(rng.choice(employees)['_id']),
+                   'creation_date': create_date_after(rng, creation_date, now),
+                   'contract_status': rng.choice(dashboard.contract_statuses)}
+        if not base_version or base_version['depth'] + 1 >= versions.snapshot_interval:
+            version.update({'text': version_text, 'depth': 0})
+        else:
+            version.update({'delta': versions.compute_delta(base_text, version_text),
+                            'base_id': str(base_version['_id']), 'depth': base_version['depth'] + 1})
+        documents['version'].append(version)
+        base_version, base_text = version, version_text
+
+
+def add_invitations(rng, documents, contract_id, companies, employees_by_company, directors, creation_date, now):
+    for _ in range(rng.randint(0, 2)):
+        creator_company, recipients_company = rng.sample(companies, 2)
+        creator = rng.choice(employees_by_company[creator_company['id']])
+        type = rng.choice(['editing', 'harmonization', 'signing'])
+        if type == 'signing':
+            recipients = [directors[recipients_company['id']]]
+        else:
+            recipients = employees_by_company[recipients_company['id']]
+        status = rng.choice(['pending', 'accepted'])
+        invitation_date = create_date_after(rng, creation_date, now)
+        for recipient in recipients:
+            documents['invitation'].append({
+                'contract_id': contract_id, 'status': status, 'creation_date': invitation_date, 'type': type,
+                'creator': {'id': str(creator['_id']), 'name': creator['name'], 'company_id': creator_company['id'],
+                            'company_name': creator_company['name']},
+                'recipient': {'id': str(recipient['_id']), 'name': recipient['name'],
+                              'company_id': recipients_company['id'], 'company_name': recipients_company['name']},
+            })
+
+
+def add_dialog(rng, documents, contract_id, employees, max_messages, creation_date, now):
+    dialog_participants = employees if rng.random() < 0.1 else rng.sample(employees, 2)
+    participants = [{'id': str(employee['_id']), 'name': employee['name']} for employee in dialog_participants]
+    dialog_id = ObjectId()
+    if rng.random() < 0.02:
+        messages_count = rng.randint(max_messages // 10, max_messages)
+    else:
+        messages_count = rng.randint(1, min(30, max_messages))
+    unread_count = rng.choice([0, 0, 1, 3])
+    message_date = create_date_after(rng, creation_date, now)
+    step = (now - message_date) / (messages_count + 1)
+    for number in range(messages_count):
+        message_date += step
+        sender = rng.choice(participants)
+        others = [participant['id'] for participant in participants if participant['id'] != sender['id']]
+        is_unread = number >= messages_count - unread_count
+        message = {'_id': ObjectId(), 'dialog_id': str(dialog_id), 'text': create_sentence(rng, message_words),
+                   'sender': sender, 'unread_by': others if is_unread else [],
+                   'read_by': [] if is_unread else others, 'creation_date': message_date}
+        documents['message'].append(message)
+    documents['dialog'].append({'_id': dialog_id, 'contract_id': contract_id, 'participants': participants,
+                                'revision': 0, 'last_message': utils.create_message_summary(message)})
+
+
+def create_date_after(rng, start_date, end_date):
+    return start_date + (end_date - start_date) * rng.random()
+
+
+def create_sentence(rng, words=text_words):
+    sentence = ' '.join(rng.choices(words, k=rng.randint(5, 25)))
+    return sentence[0].upper() + sentence[1:] + '.'
+
+
+def create_text(rng, length, comments_count):
+    paragraphs, text_size = [], 0
+    while text_size < length:
+        paragraph = ' '.join(create_sentence(rng) for _ in range(rng.randint(2, 6)))
+        paragraphs.append(paragraph)
+        text_size += len(paragraph) + 7
+    for number in range(comments_count):
+        paragraph_index = rng.randrange(len(paragraphs))
+        marker = f'<span style="background-color:hsl(40,{number}%,80%);">'
+        paragraphs[paragraph_index] = f'{marker}{paragraphs[paragraph_index]}</span>'
+    return ''.join(f'<p>{paragraph}</p>' for paragraph in paragraphs)
+
+
+def edit_text(rng, text):
+    position = rng.randrange(len(text))
+    return text[:position] + create_sentence(rng) + text[position + rng.randint(0, 200):]
@@ -0,0 +1,47 @@
+import app
+import pytest
+from bson import ObjectId
+
+
+@pytest.fixture
+def client(monkeypatch):
+    def find_one_document(collection_name, query, projection=None):
+        if collection_name == 'dialog':
+            return {'_id': query['_id'], 'contract_id': contract_id, 'participants': []}
+        if collection_name == 'version':
+            return {'_id': query['_id'], 'contract_id': contract_id}
+        assert query['deletion'] == {'$exists': False}
+        return None
+
+    def write(*args, **kwargs):
+        raise AssertionError('tombstoned contract was written to')
+
+    contract_id = str(ObjectId())
+    monkeypatch.setattr(app.mongo, 'find_one_document', find_one_document)
+    monkeypatch.setattr(app.mongo, 'update_one_by_query', lambda *args: 0)
+    for name in ['insert_one_document', 'insert_documents', 'find_documents', 'find_by_ids', 'bulk_write',
+                 'find_one_and_update', 'delete_one_document']:
+        monkeypatch.setattr(app.mongo, name, write)
+    client = app.app.test_client()
+    client.contract_id = contract_id
+    return client
+
+
+@pytest.mark.parametrize('method, url, data', [
+    ('post', '/comment/create', {'userName': 'Ivan', 'text': 'Why?', 'number': 0, 'contractText': '<p>Term</p>'}),
+    ('put', '/comment/update', {'userName': 'Ivan', 'commentNumber': 0, 'responseText': 'Because'}),
+    ('put', '/contract/update', {'id': None, 'text': '<p>Term</p>', 'onlyText': True}),
+    ('post', '/dialog/create', {'userId': 'e1', 'userName': 'Ivan', 'messageText': 'Hi', 'recipient': 'e2'}),
+    ('post', '/dialog/create', {'userId': 'e1', 'userName': 'Ivan', 'messageText': 'Hi', 'recipient': 'everybody'}),
+    ('post', '/invitations/create', {'reason': 'editing', 'senderId': 'e1', 'company': 'c1'}),
+    ('delete', '/comment/delete', {'number': 0, 'id': 0, 'contractTextAfterRemoval': '<p>Term</p>'}),
+    ('delete', f'/contract/version/delete/{ObjectId()}', {}),
+    ('post', '/message/create', {'dialogId': str(ObjectId()), 'messageText': 'Hi',
+                                 'sender': {'id': 'e1', 'name': 'Ivan'}}),
+])
+def test_writes_to_tombstoned_contracts_return_404(client, method, url, data):
+    if url == '/contract/update':
+        data = {**data, 'id': client.contract_id}
+    elif url != '/message/create' and not url.startswith('/contract/version/delete/'):
+        data = {**data, 'contractId': client.contract_id}
+    assert getattr(client, method)(url, json=data).status_code == 404
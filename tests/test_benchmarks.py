@@ -0,0 +1,38 @@
+import benchmarks
+import itertools
+
+
+def test_dependent_scenarios_run_alone(monkeypatch):
+    ids = (str(number) for number in itertools.count())
+    inserted_comments = []
+    monkeypatch.setattr(benchmarks.mongo, 'insert_one_document', lambda collection_name, document: next(ids))
+    monkeypatch.setattr(benchmarks.mongo, 'insert_documents',
+                        lambda collection_name, documents: inserted_comments.extend(documents))
+    monkeypatch.setattr(benchmarks.dashboard, 'change_contract_counts', lambda *args: None)
+    monkeypatch.setattr(benchmarks.versions, 'save_version', lambda *args: next(ids))
+    context = {'contract_id': 'c', 'employee_id': 'e', 'employee_name': 'Ivan', 'text': '<p>Term</p>',
+               'companies': [{'id': 'co1', 'name': 'Zila'}, {'id': 'co2', 'name': 'ABC'}], 'since': '',
+               'other_employee_id': 'e2', 'other_company_id': 'co2', 'role_name': 'lawyer', 'dialog_id': 'd',
+               'invitation_id': 'i', 'notification_id': 'n', 'version_id': 'v'}
+    scenarios = {name: (path, body, prepare) for name, _, path, body, prepare in benchmarks.create_scenarios(context)}
+    requests_count = 3
+    for name in ['delete_contract', 'delete_contract_version']:
+        path, body, prepare = scenarios[name]
+        prepare(requests_count)
+        paths = [benchmarks.call(path, number) for number in range(requests_count)]
+        assert len(set(paths)) == requests_count
+    for name in ['update_comment', 'delete_comment']:
+        path, body, prepare = scenarios[name]
+        prepare(requests_count)
+    comment_numbers = {comment['number'] for comment in inserted_comments}
+    assert scenarios['update_comment'][1]['commentNumber'] in comment_numbers
+    assert {benchmarks.call(scenarios['delete_comment'][1], number)['number']
+            for number in range(requests_count)} <= comment_numbers
+
+
+def test_json_encoding_payload_matches_contract_list_records():
+    contract = benchmarks.create_contracts(2)[1]
+    assert 'text' not in contract and 'comment_anchors' not in contract
+    assert isinstance(contract['creation_date'], benchmarks.datetime)
+    assert set(contract['status']) == {'name', 'companies'}
+    assert set(contract['status']['companies']) == {company['name'] for company in contract['companies']}
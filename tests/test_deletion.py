@@ -0,0 +1,150 @@
+import copy
+import deletion
+import pytest
+from bson import ObjectId
+
+
+class Interrupted(Exception):
+    pass
+
+
+def get_field(document, field):
+    for part in field.split('.'):
+        document = document.get(part) if isinstance(document, dict) else None
+    return document
+
+
+def matches(document, query):
+    for field, condition in query.items():
+        value = get_field(document, field)
+        if isinstance(condition, dict) and '$in' in condition:
+            if value not in condition['$in']:
+                return False
+        elif isinstance(condition, dict) and '$exists' in condition:
+            if (value is not None) != condition['$exists']:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+class PurgeStore:
+    def __init__(self):
+        self.collections, self.interruptions = {}, {}
+
+    def insert(self, collection_name, document):
+        document = {'_id': ObjectId(), **document}
+        self.collections.setdefault(collection_name, {})[document['_id']] = document
+        return document['_id']
+
+    def documents(self, collection_name, query=None):
+        return [document for document in self.collections.get(collection_name, {}).values()
+                if matches(document, query or {})]
+
+    def interrupt(self, name):
+        if self.interruptions.get(name):
+            self.interruptions[name] -= 1
+            raise Interrupted(name)
+
+    def find_one_document(self, collection_name, query, projection=None):
+        return next(iter(self.documents(collection_name, query)), None)
+
+    def find_documents(self, collection_name, query, sort=None, limit=0, projection=None):
+        documents = self.documents(collection_name, query)
+        return iter(documents[:limit] if limit else documents)
+
+    def update_one_by_query(self, collection_name, query, update):
+        documents = self.documents(collection_name, query)[:1]
+        for document in documents:
+            for field, value in update.get('$set', {}).items():
+                *path, name = field.split('.')
+                for part in path:
+                    document = document.setdefault(part, {})
+                document[name] = value
+        return len(documents)
+
+    def update_many_documents(self, collection_name, query, update):
+        documents = self.documents(collection_name, query)
+        for document in documents:
+            document.update(update['$set'])
+        return len(documents)
+
+    def delete_many_documents(self, collection_name, query):
+        self.interrupt(f'delete {collection_name}')
+        for document in self.documents(collection_name, query):
+            del self.collections[collection_name][document['_id']]
+
+    def delete_one_document(self, collection_name, query):
+        for document in self.documents(collection_name, query)[:1]:
+            del self.collections[collection_name][document['_id']]
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store, discounts = PurgeStore(), []
+    for name in ['find_one_document', 'find_documents', 'update_one_by_query', 'update_many_documents',
+                 'delete_many_documents', 'delete_one_document']:
+        monkeypatch.setattr(deletion.mongo, name, getattr(store, name))
+
+    def change_contract_counts(companies_id, status_name, amount):
+        store.interrupt('dashboard')
+        discounts.append(('contracts', status_name, amount))
+
+    def discount_items(counter_name, query):
+        discounts.extend((counter_name, document['_id']) for document in store.documents(counter_name[:-1], query))
+
+    monkeypatch.setattr(deletion.dashboard, 'change_contract_counts', change_contract_counts)
+    monkeypatch.setattr(deletion.dashboard, 'discount_invitations', lambda query: None)
+    monkeypatch.setattr(deletion.counters, 'discount_items', discount_items)
+    monkeypatch.setattr(deletion.counters, 'change_counters', lambda employees_id, counter_name, amount=1: None)
+    store.discounts = discounts
+    return store
+
+
+def create_deleted_contract(store, invitations_count):
+    contract_id = str(store.insert('contract', {'companies': [{'id': 'c1'}], 'status': {'name': 'creating'}}))
+    for _ in range(invitations_count):
+        store.insert('invitation', {'contract_id': contract_id, 'status': 'pending'})
+    assert deletion.mark_deleted(contract_id)
+    return contract_id
+
+
+def test_purge_removes_every_stage(store):
+    contract_id = create_deleted_contract(store, 3)
+    dialog_id = store.insert('dialog', {'contract_id': contract_id, 'participants': [{'id': 'e1'}]})
+    store.insert('message', {'dialog_id': str(dialog_id), 'unread_by': ['e1']})
+    deletion.purge_contract(contract_id)
+    assert all(not documents for documents in store.collections.values())
+    assert len(store.discounts) == 1 + 3 + 1
+
+
+def test_interrupted_statistics_stage_is_not_discounted_again(store):
+    contract_id = create_deleted_contract(store, 0)
+    store.interruptions['dashboard'] = 1
+    with pytest.raises(Interrupted):
+        deletion.purge_contract(contract_id)
+    deletion.purge_contract(contract_id)
+    assert not store.collections['contract']
+    assert store.discounts == []
+
+
+def test_duplicate_purge_discounts_statistics_once(store, monkeypatch):
+    contract_id = create_deleted_contract(store, 0)
+    stale_contract = copy.deepcopy(store.find_one_document('contract', {}))
+    deletion.purge_contract(contract_id)
+    monkeypatch.setattr(deletion.mongo, 'find_one_document', lambda *args: stale_contract)
+    deletion.purge_contract(contract_id)
+    assert store.discounts == [('contracts', 'creating', -1)]
+
+
+def test_interrupted_batch_is_not_discounted_again(store, monkeypatch):
+    monkeypatch.setattr(deletion, 'purge_batch_size', 2)
+    contract_id = create_deleted_contract(store, 5)
+    store.interruptions['delete invitation'] = 2
+    for _ in range(2):
+        with pytest.raises(Interrupted):
+            deletion.purge_contract(contract_id)
+    deletion.purge_contract(contract_id)
+    assert not store.collections['invitation'] and not store.collections['contract']
+    discounted_invitations = [discount[1] for discount in store.discounts if discount[0] == 'invitations']
+    assert len(discounted_invitations) == len(set(discounted_invitations)) == 5
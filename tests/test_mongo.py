@@ -0,0 +1,77 @@
+import base64
+import mongo
+import pytest
+from bson import ObjectId
+from datetime import datetime
+
+
+def test_cursor_round_trip():
+    last_id = ObjectId()
+    cursor = mongo.encode_cursor(2, 'creation_date', True, datetime(2021, 1, 1, 12, 30), last_id)
+    assert mongo.decode_cursor(cursor, 'creation_date', True) == (2, datetime(2021, 1, 1, 12, 30), last_id)
+
+
+def test_cursor_keeps_nested_sort_values():
+    last_id = ObjectId()
+    cursor = mongo.encode_cursor(1, 'status.name', False, 'signing', last_id)
+    assert mongo.decode_cursor(cursor, 'status.name', False) == (1, 'signing', last_id)
+
+
+@pytest.mark.parametrize('sort_field, descending', [('name', True), ('creation_date', False)])
+def test_cursor_rejects_other_sorting(sort_field, descending):
+    cursor = mongo.encode_cursor(1, 'creation_date', True, datetime(2021, 1, 1), ObjectId())
+    with pytest.raises(mongo.InvalidCursor):
+        mongo.decode_cursor(cursor, sort_field, descending)
+
+
+@pytest.mark.parametrize('cursor', [
+    'not base64!',
+    base64.urlsafe_b64encode(b'not json').decode(),
+    base64.urlsafe_b64encode(b'[1, 2]').decode(),
+    base64.urlsafe_b64encode(b'42').decode(),
+    base64.urlsafe_b64encode(b'[0, "_id", true, null, {"$oid": "60338c13136d90fcdc76de24"}]').decode(),
+    base64.urlsafe_b64encode(b'["1", "_id", true, null, {"$oid": "60338c13136d90fcdc76de24"}]').decode(),
+    base64.urlsafe_b64encode(b'[1, "_id", true, null, "60338c13136d90fcdc76de24"]').decode(),
+    base64.urlsafe_b64encode(b'\xff\xfe').decode(),
+])
+def test_cursor_rejects_malformed_values(cursor):
+    with pytest.raises(mongo.InvalidCursor):
+        mongo.decode_cursor(cursor, '_id', True)
+
+
+def test_build_keyset_condition_breaks_ties_on_id():
+    last_id = ObjectId()
+    assert mongo.build_keyset_condition('name', False, 'Kotov', last_id) == {
+        '$or': [{'name': {'$gt': 'Kotov'}}, {'name': 'Kotov', '_id': {'$gt': last_id}}]}
+    assert mongo.build_keyset_condition('_id', True, last_id, last_id) == {'_id': {'$lt': last_id}}
+
+
+def test_date_sort_key_orders_legacy_strings_with_datetimes():
+    dates = [datetime(2021, 3, 2, 10, 0), '01.03.21 09:15:00', '2021-03-01T08:00:00', None]
+    assert sorted(dates, key=mongo.get_date_sort_key) == [None, '2021-03-01T08:00:00', '01.03.21 09:15:00',
+                                                          datetime(2021, 3, 2, 10, 0)]
+
+
+def test_text_compression_reads_settings_on_use(monkeypatch):
+    document = {'text': 'clause ' * 10}
+    monkeypatch.setenv('MONGO_TEXT_COMPRESSION_THRESHOLD', '10')
+    compressed_document = mongo.compress_texts('contract', document)
+    assert isinstance(compressed_document['text'], mongo.Binary)
+    assert mongo.decompress_text(compressed_document['text']) == document['text']
+    monkeypatch.setenv('MONGO_TEXT_COMPRESSOR', 'none')
+    assert mongo.compress_texts('contract', document) == document
+
+
+def test_updates_stamp_updated_date_on_exported_collections():
+    update = mongo.encode_update('invitation', {'$set': {'status': 'accepted'}})
+    assert update['$set']['status'] == 'accepted' and isinstance(update['$set']['updated_date'], datetime)
+    update = mongo.encode_update('notification', {'$inc': {'revision': 1}})
+    assert update['$inc'] == {'revision': 1} and isinstance(update['$set']['updated_date'], datetime)
+    assert mongo.encode_update('comment', {'$push': {'related_comments': {}}}) == {'$push': {'related_comments': {}}}
+
+
+def test_inserts_stamp_updated_date_in_place():
+    dialog = {'contract_id': 'id'}
+    assert mongo.encode_new_document('dialog', dialog) is dialog
+    assert isinstance(dialog['updated_date'], datetime)
+    assert 'updated_date' not in mongo.encode_new_document('message', {'text': 'Hi'})
@@ -0,0 +1,62 @@
+import pytest
+import search
+
+
+def test_index_message_scopes_entry_by_participant(monkeypatch):
+    saved = []
+    monkeypatch.setattr(search, 'save_entries', lambda entry, scopes_id: saved.append(scopes_id))
+    dialog = {'_id': 'd1', 'contract_id': 'c1', 'participants': [{'id': 'e1'}, {'id': 'e2'}]}
+    search.index_message({'_id': 'm1', 'text': 'price', 'creation_date': None}, dialog)
+    assert saved == [['e1', 'e2']]
+
+
+class SearchStore:
+    def __init__(self, entries, dialogs_count):
+        self.entries, self.queries = entries, []
+        self.dialogs = [{'_id': f'd{number}', 'participants': [{'id': 'e1'}]} for number in range(dialogs_count)]
+
+    def match_entries(self, query):
+        deleted_contracts_id = query['$and'][1]['contract_id']['$nin'] if '$and' in query else []
+        scope_query = query['$and'][0] if '$and' in query else query
+        return [entry for entry in self.entries
+                if entry['scope_id'] == scope_query['scope_id'] and entry['contract_id'] not in deleted_contracts_id]
+
+    def find_documents(self, collection_name, query, sort=None, limit=0, projection=None):
+        self.queries.append(collection_name)
+        if collection_name == 'dialog':
+            return self.dialogs
+        if '_id' in query:
+            return [{'_id': entry_id, 'text': 'price'} for entry_id in query['_id']['$in']]
+        return [{**entry, 'kind': 'contract', 'item_id': entry['contract_id'], 'score': 1.0}
+                for entry in self.match_entries(query)]
+
+    def count_documents(self, collection_name, query):
+        self.queries.append(collection_name)
+        return len(self.match_entries(query))
+
+
+def use_store(monkeypatch, store):
+    monkeypatch.setattr(search.deletion, 'find_deleted_contracts_id', lambda: ['c2'])
+    monkeypatch.setattr(search.mongo, 'find_documents', store.find_documents)
+    monkeypatch.setattr(search.mongo, 'count_documents', store.count_documents)
+
+
+def test_search_counts_only_live_entries_in_company_and_employee_scopes(monkeypatch):
+    store = SearchStore([
+        {'_id': 'contract:c1:c1:co1', 'entry_id': 'contract:c1:c1', 'scope_id': 'co1', 'contract_id': 'c1'},
+        {'_id': 'contract:c2:c2:co1', 'entry_id': 'contract:c2:c2', 'scope_id': 'co1', 'contract_id': 'c2'},
+        {'_id': 'message:c1:m1:e1', 'entry_id': 'message:c1:m1', 'scope_id': 'e1', 'contract_id': 'c1'},
+        {'_id': 'message:c1:m2:e2', 'entry_id': 'message:c1:m2', 'scope_id': 'e2', 'contract_id': 'c1'},
+    ], 1)
+    use_store(monkeypatch, store)
+    result = search.search('co1', 'e1', 'price', 1, 1)
+    assert result['pagesCount'] == 2
+    assert [record['contract_id'] for record in result['records']] == ['c1']
+
+
+@pytest.mark.parametrize('dialogs_count', [1, 300])
+def test_search_queries_do_not_depend_on_dialogs_count(monkeypatch, dialogs_count):
+    store = SearchStore([], dialogs_count)
+    use_store(monkeypatch, store)
+    search.search('co1', 'e1', 'price', 3, 10)
+    assert store.queries == ['search_entry'] * 5
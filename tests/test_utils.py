@@ -0,0 +1,62 @@
+import pytest
+import utils
+
+
+def create_marker(number):
+    return f'<span style="background-color:hsl(40,{number}%,80%);">'
+
+
+def test_find_comment_anchors_keeps_first_marker_position():
+    text = f'<p>Intro</p><p>{create_marker(2)}Payment</span></p><p>{create_marker(0)}Term</span> ' \
+           f'{create_marker(2)}again</span></p>'
+    assert utils.find_comment_anchors(text) == {'2': text.index(create_marker(2)), '0': text.index(create_marker(0))}
+
+
+def test_find_comment_anchors_ignores_other_highlights():
+    text = '<p><span style="background-color:hsl(120,5%,80%);">Green</span> plain text</p>'
+    assert utils.find_comment_anchors(text) == {}
+
+
+def test_comments_sort_by_anchor_with_unanchored_first():
+    anchors = utils.find_comment_anchors(f'{create_marker(1)}a</span>{create_marker(0)}b</span>')
+    comments = [{'number': 0}, {'number': 1}, {'number': 5}]
+    ordered = sorted(comments, key=lambda comment: utils.key_func_for_sorting_comments(comment, anchors))
+    assert [comment['number'] for comment in ordered] == [5, 1, 0]
+
+
+def test_apply_text_patch_retains_deletes_and_inserts():
+    patch = [['retain', 3], ['delete', 7], ['insert', 'Delivery'], ['retain', 4], ['insert', ' in time']]
+    assert utils.apply_text_patch('<p>Payment</p>', patch) == '<p>Delivery</p> in time'
+
+
+@pytest.mark.parametrize('patch', [
+    [['retain', -1]],
+    [['delete', -2]],
+    [['retain', 20]],
+    [['retain', 10], ['delete', 5]],
+    [['replace', 'text']],
+])
+def test_apply_text_patch_rejects_out_of_range_operations(patch):
+    with pytest.raises(ValueError):
+        utils.apply_text_patch('<p>Term</p>', patch)
+
+
+@pytest.mark.parametrize('text_patch', [
+    [['retain', 1]],
+    {'ops': [['retain', 1]]},
+    {'baseRevision': 1},
+    {'baseRevision': 1, 'ops': 'retain'},
+    {'baseRevision': '1', 'ops': []},
+    {'baseRevision': 1, 'ops': [['retain']]},
+    {'baseRevision': 1, 'ops': [['retain', -1]]},
+    {'baseRevision': 1, 'ops': [['delete', '2']]},
+    {'baseRevision': 1, 'ops': [['insert', 2]]},
+    {'baseRevision': 1, 'ops': [['replace', 'text']]},
+])
+def test_is_valid_text_patch_rejects_malformed_patches(text_patch):
+    assert not utils.is_valid_text_patch(text_patch)
+
+
+def test_is_valid_text_patch_accepts_well_formed_patches():
+    assert utils.is_valid_text_patch({'baseRevision': 0, 'ops': [['retain', 1], ['delete', 0], ['insert', 'a']]})
+    assert utils.is_valid_text_patch({'baseRevision': None, 'ops': []})
@@ -0,0 +1,90 @@
+import pytest
+import random
+import versions
+from bson import ObjectId
+
+
+@pytest.mark.parametrize('base_text, text', [
+    ('', ''),
+    ('', '<p>New contract</p>'),
+    ('<p>Old contract</p>', ''),
+    ('<p>Same text</p>', '<p>Same text</p>'),
+    ('<p>The supplier shall deliver</p>', '<p>The supplier shall promptly deliver</p>'),
+    ('<p>The supplier shall deliver</p>', '<p>The supplier deliver</p>'),
+    ('<p>Payment within 10 days</p>', '<p><strong>Payment</strong> within 30 days.</p>'),
+    ('a  b\n\nc', 'a b\nc d'),
+    ('completely different', '<p>nothing in common here</p>'),
+    ('a < b', 'a < b <c'),
+])
+def test_delta_round_trip(base_text, text):
+    assert versions.apply_delta(base_text, versions.compute_delta(base_text, text)) == text
+
+
+def test_delta_round_trip_on_random_edits():
+    rng = random.Random(7)
+    words = ['<p>', '</p>', 'party', 'shall', 'deliver', ' ', '  ', '\n', 'price', '<b>', '</b>', 'term.']
+    for _ in range(200):
+        base_text = ''.join(rng.choices(words, k=rng.randint(0, 40)))
+        tokens = list(base_text)
+        for _ in range(rng.randint(0, 5)):
+            position = rng.randint(0, len(tokens))
+            tokens[position:position + rng.randint(0, 4)] = rng.choice(words)
+        text = ''.join(tokens)
+        assert versions.apply_delta(base_text, versions.compute_delta(base_text, text)) == text
+
+
+def test_delta_reuses_unchanged_ranges():
+    base_text = '<p>' + 'unchanged clause ' * 50 + '</p>'
+    text = base_text.replace('</p>', 'added clause</p>')
+    delta = versions.compute_delta(base_text, text)
+    inserted_length = sum(len(item) for item in delta if isinstance(item, str))
+    assert inserted_length < 20
+
+
+class VersionStore:
+    def __init__(self):
+        self.documents = {}
+
+    def find_one_document(self, collection_name, query, projection=None):
+        return next(self.find_documents(collection_name, query), None)
+
+    def find_documents(self, collection_name, query, sort=None, limit=0, projection=None):
+        for document in list(self.documents.values()):
+            if all(document.get(field) == value for field, value in query.items()):
+                yield dict(document)
+
+    def insert(self, document):
+        document = {'_id': ObjectId(), **document}
+        self.documents[document['_id']] = document
+        return str(document['_id'])
+
+    def update_one_by_query(self, collection_name, query, update):
+        if collection_name == 'version':
+            document = self.documents[query['_id']]
+            document.update(update.get('$set', {}))
+            for field in update.get('$unset', {}):
+                document.pop(field, None)
+
+    def delete_one_document(self, collection_name, query):
+        self.documents.pop(query['_id'])
+
+
+def test_delete_version_re_encodes_every_successor(monkeypatch):
+    store, contract_id = VersionStore(), str(ObjectId())
+    for name in ['find_one_document', 'find_documents', 'update_one_by_query', 'delete_one_document']:
+        monkeypatch.setattr(versions.mongo, name, getattr(store, name))
+    versions.get_version_text.cache_clear()
+    texts = ['<p>First draft</p>', '<p>Second draft</p>', '<p>Second draft, branch one</p>',
+             '<p>Second draft, branch two</p>']
+    first_id = store.insert({'contract_id': contract_id, 'text': texts[0], 'depth': 0})
+    second_id = store.insert({'contract_id': contract_id, 'depth': 1,
+                              **versions.create_version_text_fields(texts[1], {'_id': first_id, 'depth': 0})})
+    second_version = {'_id': second_id, 'depth': 1}
+    branches_id = [store.insert({'contract_id': contract_id, 'depth': 2,
+                                 **versions.create_version_text_fields(text, second_version)}) for text in texts[2:]]
+    versions.delete_version(second_id)
+    versions.get_version_text.cache_clear()
+    for branch_id, text in zip(branches_id, texts[2:]):
+        assert store.documents[ObjectId(branch_id)]['base_id'] == first_id
+        assert versions.get_version_text(branch_id) == text
+    versions.get_version_text.cache_clear()
@@ -1,23 +1,51 @@
+from bson import Binary, ObjectId
 from datetime import datetime
-import json
-import math
-
-
-def apply_pagination(current_page, per_page, records: list):
-    records_count = len(records)
-    min_pages_count = 1
-    pages_count = math.ceil(records_count / per_page) or min_pages_count
-    if current_page > pages_count:
-        init_page = 1
-        current_page = init_page
-    records_start_index = (current_page - 1) * per_page
-    records_end_index = current_page * per_page
-    records = records[records_start_index:records_end_index]
-    return {'currentPage': current_page, 'pagesCount': pages_count, 'records': records}
-
-
-def convert_mongo_data_to_json(data):
-    return json.dumps(data, default=str)
+import base64
+import re
+
+try:
+    from flask.json.provider import DefaultJSONProvider
+except ImportError:
+    # Flask < 2.2, which celery 5.0's click pin resolves to, customizes JSON through app.json_encoder
+    from flask.json import JSONEncoder
+    DefaultJSONProvider = None
+
+
+date_format = '%d.%m.%y %H:%M:%S'
+short_date_format = '%d.%m.%y %H:%M'
+message_preview_length = 200
+messages_page_size = 50
+max_messages_page_size = 200
+update_attempts = 3
+export_batch_size = 500
+contract_list_projection = {'text': False, 'comment_anchors': False}
+version_metadata_projection = {'contract_id': True, 'creator_id': True, 'creation_date': True, 'contract_status': True}
+notification_texts = {
+    'editing': 'Invitation to editing contract was received',
+    'harmonization': 'Contract needs a harmonization for changing its status to "harmonized"',
+    'signing': 'Contract is harmonized and needs to be signed for changing its status to "signed"',
+    'archived': 'Contract is archived'
+}
+comment_marker_pattern = re.compile(r'<span style="background-color:hsl\(40,(\d+)%,80%\);">')
+
+
+if DefaultJSONProvider:
+    class MongoJSONProvider(DefaultJSONProvider):
+        @staticmethod
+        def default(value):
+            return convert_mongo_value(value, DefaultJSONProvider.default)
+else:
+    class MongoJSONEncoder(JSONEncoder):
+        def default(self, value):
+            return convert_mongo_value(value, super().default)
+
+
+def convert_mongo_value(value, default):
+    if isinstance(value, (ObjectId, datetime)):
+        return str(value)
+    if isinstance(value, Binary):
+        return base64.b64encode(value).decode()
+    return default(value)
 
 
 def create_initial_status(companies: list):
@@ -28,6 +56,65 @@ def create_initial_status(companies: list):
     return {'name': 'creating', 'companies': companies_map}
 
 
+def is_valid_text_patch(text_patch):
+    if not isinstance(text_patch, dict) or not isinstance(text_patch.get('ops'), list):
+        return False
+    base_revision = text_patch.get('baseRevision', False)
+    if base_revision is not None and (not isinstance(base_revision, int) or isinstance(base_revision, bool)):
+        return False
+    for operation in text_patch['ops']:
+        if not isinstance(operation, list) or len(operation) != 2:
+            return False
+        name, value = operation
+        if name == 'insert':
+            if not isinstance(value, str):
+                return False
+        elif name not in ('retain', 'delete') or not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            return False
+    return True
+
+
+def apply_text_patch(text, patch: list):
+    position, text_parts = 0, []
+    for operation, value in patch:
+        if operation in ('retain', 'delete') and value < 0:
+            raise ValueError(f'Negative text patch length: {value}')
+        if operation == 'retain':
+            text_parts.append(text[position:position + value])
+            position += value
+        elif operation == 'delete':
+            position += value
+        elif operation == 'insert':
+            text_parts.append(value)
+        else:
+            raise ValueError(f'Unknown text patch operation: {operation}')
+    if position > len(text):
+        raise ValueError('Text patch is longer than the text')
+    text_parts.append(text[position:])
+    return ''.join(text_parts)
+
+
+def create_dialog_entity(dialog, employee_id):
+    last_message = dialog['last_message']
+    if last_message['sender']['id'] == employee_id:
+        is_read = bool(last_message['read_by'])
+    else:
+        is_read = employee_id not in last_message['unread_by']
+    return {
+        '_id': str(last_message['_id']), 'dialog_id': str(dialog['_id']), 'text': last_message['text'],
+        'sender': last_message['sender'], 'is_read': is_read,
+        'creation_date': format_date(last_message['creation_date'], date_format),
+        'contract_id': dialog['contract_id'], 'participants': dialog['participants']
+    }
+
+
+def create_message_summary(message):
+    return {
+        '_id': message['_id'], 'sender': message['sender'], 'text': message['text'][:message_preview_length],
+        'creation_date': message['creation_date'], 'unread_by': message['unread_by'], 'read_by': message['read_by']
+    }
+
+
 def define_action_on_status_and_acceptances(user_company_name, user_role, contact_status):
     status_name = contact_status['name']
     actions_map = {'creating': 'Harmonize', 'harmonization': 'Harmonize', 'harmonized': 'Sign', 'signing': 'Sign',
@@ -49,10 +136,29 @@ def define_action_on_status_and_acceptances(user_company_name, user_role, contac
     return action_on_status, companies_acceptances
 
 
-def key_func_for_sorting_comments(comment, contract_text):
-    comment_number = comment['number']
-    search_substring = f'<span style="background-color:hsl(40,{comment_number}%,80%);">'
-    return contract_text.find(search_substring)
+def define_db_sorting(sorting_field, reverse, fields_map: dict):
+    if sorting_field in [None, 'undefined']:
+        sorting_field, descending = 'creation_date', True
+    else:
+        descending = reverse == 'true'
+    return fields_map.get(sorting_field, sorting_field), descending
+
+
+def find_comment_anchors(contract_text):
+    comment_anchors = {}
+    for marker in comment_marker_pattern.finditer(contract_text):
+        comment_anchors.setdefault(marker.group(1), marker.start())
+    return comment_anchors
+
+
+def format_date(value, output_format=short_date_format):
+    if isinstance(value, datetime):
+        return value.strftime(output_format)
+    return value
+
+
+def key_func_for_sorting_comments(comment, comment_anchors: dict):
+    return comment_anchors.get(str(comment['number']), -1)
 
 
 def remove_companies_from_invitation(invitation_variants, invitations):
@@ -70,12 +176,6 @@ def remove_companies_from_invitation(invitation_variants, invitations):
     return invitation_variants
 
 
-def transform_field(field_value, field_name):
-    if field_name == 'creation_date':
-        return datetime.strptime(field_value, '%d.%m.%y %H:%M:%S').strftime('%y.%m.%d %H:%M:%S')
-    return field_value
-
-
 def update_status(action_on_status, user_company_name, user_role, contact_status):
     current_status = contact_status['name']
     actions_map = {'Harmonize': ['creating', 'harmonization'], 'Sign': ['harmonized', 'signing'], 'Archive': ['signed']}
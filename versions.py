@@ -0,0 +1,94 @@
+import difflib
+import functools
+import mongo
+import re
+from bson import ObjectId
+
+
+snapshot_interval = 10
+# Tokens must cover the whole text, including a stray '<' that never closes, or the delta offsets drift
+token_pattern = re.compile(r'<[^>]*>|[^<\s]+|\s+|<')
+
+
+def compute_delta(base_text, text):
+    base_tokens, tokens = token_pattern.findall(base_text), token_pattern.findall(text)
+    base_offsets, offsets = get_token_offsets(base_tokens), get_token_offsets(tokens)
+    prefix_length = 0
+    max_prefix_length = min(len(base_tokens), len(tokens))
+    while prefix_length < max_prefix_length and base_tokens[prefix_length] == tokens[prefix_length]:
+        prefix_length += 1
+    suffix_length = 0
+    max_suffix_length = max_prefix_length - prefix_length
+    while suffix_length < max_suffix_length and base_tokens[-suffix_length - 1] == tokens[-suffix_length - 1]:
+        suffix_length += 1
+    base_middle = base_tokens[prefix_length:len(base_tokens) - suffix_length]
+    middle = tokens[prefix_length:len(tokens) - suffix_length]
+    delta = [[0, base_offsets[prefix_length]]] if prefix_length else []
+    for tag, base_start, base_end, start, end in difflib.SequenceMatcher(None, base_middle, middle).get_opcodes():
+        if tag == 'equal':
+            delta.append([base_offsets[prefix_length + base_start], base_offsets[prefix_length + base_end]])
+        elif start != end:
+            delta.append(text[offsets[prefix_length + start]:offsets[prefix_length + end]])
+    if suffix_length:
+        delta.append([base_offsets[len(base_tokens) - suffix_length], base_offsets[-1]])
+    return delta
+
+
+def apply_delta(base_text, delta: list):
+    return ''.join(base_text[item[0]:item[1]] if isinstance(item, list) else item for item in delta)
+
+
+def get_token_offsets(tokens: list):
+    offsets = [0]
+    for token in tokens:
+        offsets.append(offsets[-1] + len(token))
+    return offsets
+
+
+@functools.lru_cache(maxsize=128)
+def get_version_text(version_id):
+    projection = {'text': True, 'delta': True, 'base_id': True}
+    version = mongo.find_one_document('version', {'_id': ObjectId(version_id)}, projection)
+    if 'delta' not in version:
+        return version['text']
+    return apply_delta(get_version_text(version['base_id']), version['delta'])
+
+
+def create_version_text_fields(text, base_version):
+    if not base_version or base_version.get('depth', 0) + 1 >= snapshot_interval:
+        return {'text': text, 'depth': 0}
+    base_id = str(base_version['_id'])
+    delta = compute_delta(get_version_text(base_id), text)
+    return {'delta': delta, 'base_id': base_id, 'depth': base_version.get('depth', 0) + 1}
+
+
+def save_version(contract_id, creator_id, text, creation_date, contract_status):
+    latest_versions = mongo.find_documents('version', {'contract_id': contract_id}, [('_id', mongo.DESC)], 1,
+                                           {'depth': True})
+    base_version = next(latest_versions, None)
+    version = {'contract_id': contract_id, 'creator_id': creator_id, 'creation_date': creation_date,
+               'contract_status': contract_status, **create_version_text_fields(text, base_version)}
+    inserted_id = mongo.insert_one_document('version', version)
+    bump_versions_revision(contract_id)
+    return inserted_id
+
+
+def delete_version(version_id):
+    version_projection = {'contract_id': True, 'base_id': True, 'depth': True}
+    version = mongo.find_one_document('version', {'_id': ObjectId(version_id)}, version_projection)
+    if not version:
+        return
+    # Concurrent save_version calls can store several deltas against the same base, so every successor is re-encoded
+    base_id = version.get('base_id')
+    base_version = {'_id': base_id, 'depth': version['depth'] - 1} if base_id else None
+    for successor in list(mongo.find_documents('version', {'base_id': version_id}, projection={'_id': True})):
+        successor_text = get_version_text(str(successor['_id']))
+        new_fields = create_version_text_fields(successor_text, base_version)
+        old_fields = {field: '' for field in ['text', 'delta', 'base_id'] if field not in new_fields}
+        mongo.update_one_by_query('version', {'_id': successor['_id']}, {'$set': new_fields, '$unset': old_fields})
+    mongo.delete_one_document('version', {'_id': ObjectId(version_id)})
+    bump_versions_revision(version['contract_id'])
+
+
+def bump_versions_revision(contract_id):
+    mongo.update_one_by_query('contract', {'_id': ObjectId(contract_id)}, {'$inc': {'versions_revision': 1}})